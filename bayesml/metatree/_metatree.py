@@ -5,6 +5,7 @@
 # Wenbin Yu <ywb827748728@163.com>
 import warnings
 import copy
+import math
 import numpy as np
 import matplotlib.pyplot as plt
 from matplotlib.colors import rgb2hex
@@ -50,6 +51,65 @@ REG_MODELS = {
     }
 
 THRESHOLD_TYPES = {'even','random'}
+_PROGRESS_INTERVAL = 100 # MCMC progress is printed once per this number of iterations
+_PROB_EPS = 1.0e-12 # meta-trees whose posterior probability is not greater than this are skipped in prediction
+
+_LOG2 = math.log(2.0)
+
+def _log(x): # math.log for scalars, but returns -inf at 0 like np.log
+    return math.log(x) if x > 0.0 else -math.inf
+
+def _log1p(x): # math.log1p for scalars, but returns -inf at -1 like np.log1p
+    return math.log1p(x) if x > -1.0 else -math.inf
+
+def _logaddexp(x,y): # np.logaddexp for scalars without ufunc dispatch
+    if x == y:
+        return x + _LOG2
+    tmp = x - y
+    if tmp > 0:
+        return x + math.log1p(math.exp(-tmp))
+    elif tmp <= 0:
+        return y + math.log1p(math.exp(tmp))
+    return tmp # nan
+
+def _update_node_post(h_g,log_marginal_likelihood,log_children_marginal_likelihood):
+    # returns the posterior h_g and the log marginal likelihood of the subtree
+    tmp1 = _log(h_g) + log_children_marginal_likelihood.sum()
+    tmp2 = _logaddexp(_log1p(-h_g) + log_marginal_likelihood, tmp1)
+    return math.exp(tmp1 - tmp2), tmp2
+
+def _partition(bin_idx,num_children): # rows of child i are order[bounds[i]:bounds[i+1]], in their original order
+    order = np.argsort(bin_idx,kind='stable')
+    bounds = np.zeros(num_children+1,dtype=int)
+    np.cumsum(np.bincount(bin_idx,minlength=num_children),out=bounds[1:])
+    return order,bounds
+
+def _rows_close(x0,x_min,x_max): # np.allclose(x,x0) given the column-wise min and max of x
+    tol = 1e-8 + 1e-5*np.abs(x0)
+    return bool(np.all(x_max - x0 <= tol) and np.all(x0 - x_min <= tol))
+
+def _all_rows_close(x): # same as np.allclose(x,x[0]), but without (n,d) temporaries
+    return _rows_close(x[0],x.min(axis=0),x.max(axis=0))
+
+def _child_k_candidates(node,c_num_assignment_vec):
+    # k_candidates lists are never modified in place after a node is built,
+    # so the children share the list of their parent unless node.k has to be removed
+    if c_num_assignment_vec[node.k] > 0:
+        child_k_candidates = node.k_candidates.copy()
+        child_k_candidates.remove(node.k)
+        return child_k_candidates
+    return node.k_candidates
+
+_IMMUTABLE_TYPES = (int,float,bool,str,np.generic,type(None))
+
+def _clone_sub_model(sub_model): # equivalent to copy.deepcopy for sub models, whose attributes are scalars and ndarrays
+    new_sub_model = copy.copy(sub_model)
+    for key,value in vars(sub_model).items():
+        if type(value) is np.ndarray:
+            setattr(new_sub_model,key,value.copy())
+        elif not isinstance(value,_IMMUTABLE_TYPES):
+            setattr(new_sub_model,key,copy.deepcopy(value))
+    return new_sub_model
 
 def _make_thresholds(x): # num_children must be 2
     tmp_x = np.unique(x)
@@ -107,7 +167,7 @@ class _Node:
         self.log_children_marginal_likelihood = log_children_marginal_likelihood
         self.log_marginal_likelihood = log_marginal_likelihood
         self._is_no_sample = False
-        self._p_indices = None
+        self._truncated_g_max = None # g_max for which _log_g and _log_not_g were cached
 
 class GenModel(base.Generative):
     """ The stochastice data generative model and the prior distribution
@@ -1194,6 +1254,7 @@ class LearnModel(base.Posterior,base.PredictiveMixin):
             ))
         self.c_num_children_vec = np.ones(self.c_dim_continuous+self.c_dim_categorical,dtype=int)*2
         self.c_num_children_vec[:] = c_num_children_vec
+        self._all_binary = bool(np.all(self.c_num_children_vec == 2))
         
         self.c_num_assignment_vec = -np.ones(self.c_dim_features,dtype=int)
         if c_num_assignment_vec is not None:
@@ -1233,10 +1294,15 @@ class LearnModel(base.Posterior,base.PredictiveMixin):
                 for j in range(self.c_num_assignment_vec[i]):
                     self._root_k_candidates.append(i)
 
+        # evenly spaced thresholds on [0,1] for each number of children
+        self._unit_grid = {num_children:np.arange(num_children+1)/num_children
+                           for num_children in set(self.c_num_children_vec.tolist())}
+
         # h0_params
         self.h0_k_weight_vec = np.ones(self.c_dim_features)
         self.h0_g = 0.5
         self.sub_h0_params = {}
+        self._sub_h0_params_values = ()
         self.h0_metatree_list = []
         self.h0_metatree_prob_vec = None
 
@@ -1244,10 +1310,14 @@ class LearnModel(base.Posterior,base.PredictiveMixin):
         self.hn_k_weight_vec = np.ones(self.c_dim_features)
         self.hn_g = 0.5
         self.sub_hn_params = {}
+        self._sub_hn_params_values = ()
         self.hn_metatree_list = []
         self.hn_metatree_prob_vec = None
 
         self._p_n = 0
+        self._p_flat_metatree_list = []
+        self._p_metatree_indices = []
+        self._scratch = {}
 
         self.set_h0_params(
             h0_k_weight_vec,
@@ -1285,24 +1355,21 @@ class LearnModel(base.Posterior,base.PredictiveMixin):
                 self._set_h0_g_recursion(node.children[i])
 
     def _set_sub_h0_params_recursion(self,node:_Node):
-        node.sub_model.set_h0_params(**self.sub_h0_params)
+        node.sub_model.set_h0_params(*self._sub_h0_params_values)
         if not node.leaf:
             for i in range(self.c_num_children_vec[node.k]):
                 self._set_sub_h0_params_recursion(node.children[i])
 
-    def _set_h0_params_recursion(self,node:_Node,original_node:_Node):
+    def _set_h0_params_recursion(self,node:_Node,original_node:_Node,get_sub_h0_params=None):
         if original_node is None:
             node.h_g = 0 if node.depth == self.c_max_depth else self.h0_g
-            node.sub_model.set_h0_params(**self.sub_h0_params)
+            node.sub_model.set_h0_params(*self._sub_h0_params_values)
             if not node.leaf:
                 for i in range(self.c_num_children_vec[node.k]):
                     self._set_h0_params_recursion(node.children[i],None)
         else:
             node.h_g = 0 if node.depth == self.c_max_depth else original_node.h_g
-            try:
-                sub_h0_params = original_node.sub_model.get_h_params()
-            except:
-                sub_h0_params = original_node.sub_model.get_h0_params()
+            sub_h0_params = get_sub_h0_params(original_node.sub_model)
             node.sub_model.set_h0_params(*sub_h0_params.values())
             if original_node.leaf or node.depth == self.c_max_depth:  # leaf node
                 node.leaf = True
@@ -1310,9 +1377,7 @@ class LearnModel(base.Posterior,base.PredictiveMixin):
                 node.k = original_node.k
                 node.children = [None for i in range(self.c_num_children_vec[node.k])]
                 node.thresholds = np.array(original_node.thresholds) if node.k < self.c_dim_continuous else None
-                child_k_candidates = node.k_candidates.copy()
-                if self.c_num_assignment_vec[node.k] > 0:
-                    child_k_candidates.remove(node.k)
+                child_k_candidates = _child_k_candidates(node,self.c_num_assignment_vec)
                 node.leaf = False
                 for i in range(self.c_num_children_vec[node.k]):
                     node.children[i] = _Node(
@@ -1327,7 +1392,7 @@ class LearnModel(base.Posterior,base.PredictiveMixin):
                     if node.thresholds is not None:
                         node.children[i].ranges[node.k,0] = node.thresholds[i]
                         node.children[i].ranges[node.k,1] = node.thresholds[i+1]
-                    self._set_h0_params_recursion(node.children[i],original_node.children[i])
+                    self._set_h0_params_recursion(node.children[i],original_node.children[i],get_sub_h0_params)
 
     def _set_hn_g_recursion(self,node:_Node):
         node.h_g = 0 if node.depth == self.c_max_depth else self.hn_g
@@ -1336,24 +1401,21 @@ class LearnModel(base.Posterior,base.PredictiveMixin):
                 self._set_hn_g_recursion(node.children[i])
 
     def _set_sub_hn_params_recursion(self,node:_Node):
-        node.sub_model.set_hn_params(**self.sub_hn_params)
+        node.sub_model.set_hn_params(*self._sub_hn_params_values)
         if not node.leaf:
             for i in range(self.c_num_children_vec[node.k]):
                 self._set_sub_hn_params_recursion(node.children[i])
 
-    def _set_hn_params_recursion(self,node:_Node,original_node:_Node):
+    def _set_hn_params_recursion(self,node:_Node,original_node:_Node,get_sub_hn_params=None):
         if original_node is None:
             node.h_g = 0 if node.depth == self.c_max_depth else self.hn_g
-            node.sub_model.set_hn_params(**self.sub_hn_params)
+            node.sub_model.set_hn_params(*self._sub_hn_params_values)
             if not node.leaf:
                 for i in range(self.c_num_children_vec[node.k]):
                     self._set_hn_params_recursion(node.children[i],None)
         else:
             node.h_g = 0 if node.depth == self.c_max_depth else original_node.h_g
-            try:
-                sub_hn_params = original_node.sub_model.get_h_params()
-            except:
-                sub_hn_params = original_node.sub_model.get_hn_params()
+            sub_hn_params = get_sub_hn_params(original_node.sub_model)
             node.sub_model.set_hn_params(*sub_hn_params.values())
             if original_node.leaf or node.depth == self.c_max_depth:  # leaf node
                 node.leaf = True
@@ -1361,24 +1423,20 @@ class LearnModel(base.Posterior,base.PredictiveMixin):
                 node.k = original_node.k
                 node.children = [None for i in range(self.c_num_children_vec[node.k])]
                 node.thresholds = np.array(original_node.thresholds) if node.k < self.c_dim_continuous else None
-                child_k_candidates = node.k_candidates.copy()
-                if self.c_num_assignment_vec[node.k] > 0:
-                    child_k_candidates.remove(node.k)
+                child_k_candidates = _child_k_candidates(node,self.c_num_assignment_vec)
                 node.leaf = False
                 for i in range(self.c_num_children_vec[node.k]):
                     node.children[i] = _Node(
                         node.depth+1,
                         k_candidates=child_k_candidates,
-                        sub_model=self.SubModel.LearnModel(
-                            **self.sub_constants,
-                            **self.sub_h0_params).set_hn_params(**self.sub_hn_params),
+                        sub_model=_clone_sub_model(self._template_sub_model),
                         ranges=np.array(node.ranges),
                         log_children_marginal_likelihood=np.zeros(2),
                         )
                     if node.thresholds is not None:
                         node.children[i].ranges[node.k,0] = node.thresholds[i]
                         node.children[i].ranges[node.k,1] = node.thresholds[i+1]
-                    self._set_hn_params_recursion(node.children[i],original_node.children[i])
+                    self._set_hn_params_recursion(node.children[i],original_node.children[i],get_sub_hn_params)
 
     def set_h0_params(self,
         h0_k_weight_vec = None,
@@ -1435,6 +1493,7 @@ class LearnModel(base.Posterior,base.PredictiveMixin):
             self.sub_h0_params = self.SubModel.LearnModel(
                 **self.sub_constants,
                 **new_sub_h0_params).get_h0_params()
+            self._sub_h0_params_values = tuple(self.sub_h0_params.values())
             if self.h0_metatree_list:
                 for h0_root in self.h0_metatree_list:
                     self._set_sub_h0_params_recursion(h0_root)
@@ -1468,7 +1527,12 @@ class LearnModel(base.Posterior,base.PredictiveMixin):
                             )
                     )
             for i in range(len(self.h0_metatree_list)):
-                self._set_h0_params_recursion(self.h0_metatree_list[i],h0_metatree_list[i])
+                if h0_metatree_list[i] is self.h0_metatree_list[i]: # already set
+                    continue
+                # sub_models of GenModel's trees have get_h_params, and those of LearnModel's trees have get_h0_params
+                sub_model_class = type(h0_metatree_list[i].sub_model)
+                get_sub_h0_params = getattr(sub_model_class,'get_h_params',None) or sub_model_class.get_h0_params
+                self._set_h0_params_recursion(self.h0_metatree_list[i],h0_metatree_list[i],get_sub_h0_params)
             if h0_metatree_prob_vec is not None:
                 self.h0_metatree_prob_vec = np.array(
                     _check.float_vec_sum_1(
@@ -1580,9 +1644,11 @@ class LearnModel(base.Posterior,base.PredictiveMixin):
                 else:
                     new_key = key
                 new_sub_hn_params[new_key] = sub_hn_params[key]
-            self.sub_hn_params = self.SubModel.LearnModel(
+            self._template_sub_model = self.SubModel.LearnModel(
                 **self.sub_constants,
-                **self.sub_h0_params).set_hn_params(**new_sub_hn_params).get_hn_params()
+                **self.sub_h0_params).set_hn_params(**new_sub_hn_params)
+            self.sub_hn_params = self._template_sub_model.get_hn_params()
+            self._sub_hn_params_values = tuple(self.sub_hn_params.values())
             if self.hn_metatree_list:
                 for hn_root in self.hn_metatree_list:
                     self._set_sub_hn_params_recursion(hn_root)
@@ -1608,15 +1674,18 @@ class LearnModel(base.Posterior,base.PredictiveMixin):
                             0,
                             self._root_k_candidates,
                             self.hn_g,
-                            sub_model=self.SubModel.LearnModel(
-                                **self.sub_constants,
-                                **self.sub_h0_params).set_hn_params(**self.sub_hn_params),
+                            sub_model=_clone_sub_model(self._template_sub_model),
                             ranges=self.c_ranges,
                             log_children_marginal_likelihood=np.zeros(2),
                             )
                     )
             for i in range(len(self.hn_metatree_list)):
-                self._set_hn_params_recursion(self.hn_metatree_list[i],hn_metatree_list[i])
+                if hn_metatree_list[i] is self.hn_metatree_list[i]: # already set
+                    continue
+                # sub_models of GenModel's trees have get_h_params, and those of LearnModel's trees have get_hn_params
+                sub_model_class = type(hn_metatree_list[i].sub_model)
+                get_sub_hn_params = getattr(sub_model_class,'get_h_params',None) or sub_model_class.get_hn_params
+                self._set_hn_params_recursion(self.hn_metatree_list[i],hn_metatree_list[i],get_sub_hn_params)
             if hn_metatree_prob_vec is not None:
                 self.hn_metatree_prob_vec = np.array(
                     _check.float_vec_sum_1(
@@ -1689,16 +1758,12 @@ class LearnModel(base.Posterior,base.PredictiveMixin):
                      new_node.ranges[new_node.k,1]])
             else:
                 new_node.thresholds = None
-            child_k_candidates = new_node.k_candidates.copy()
-            if self.c_num_assignment_vec[new_node.k] > 0:
-                child_k_candidates.remove(new_node.k)
+            child_k_candidates = _child_k_candidates(new_node,self.c_num_assignment_vec)
             new_node.children[0] = _Node(
                 new_node.depth+1,
                 child_k_candidates,
                 h_g=self.h0_g,
-                sub_model=self.SubModel.LearnModel(
-                    **self.sub_constants,
-                    **self.sub_h0_params).set_hn_params(**self.sub_hn_params),
+                sub_model=_clone_sub_model(self._template_sub_model),
                 ranges=np.array(new_node.ranges),
                 log_children_marginal_likelihood=np.zeros(2),
                 )
@@ -1709,9 +1774,7 @@ class LearnModel(base.Posterior,base.PredictiveMixin):
                 new_node.depth+1,
                 child_k_candidates,
                 h_g=self.h0_g,
-                sub_model=self.SubModel.LearnModel(
-                    **self.sub_constants,
-                    **self.sub_h0_params).set_hn_params(**self.sub_hn_params),
+                sub_model=_clone_sub_model(self._template_sub_model),
                 ranges=np.array(new_node.ranges),
                 log_children_marginal_likelihood=np.zeros(2),
                 )
@@ -1732,42 +1795,62 @@ class LearnModel(base.Posterior,base.PredictiveMixin):
             return node.log_marginal_likelihood
         else:  # inner node
             if node.k < self.c_dim_continuous:
-                for i in range(self.c_num_children_vec[node.k]):
-                    if i == 0:
-                        indices = x_continuous[:,node.k] < node.thresholds[i+1]
-                    elif i == self.c_num_children_vec[node.k]-1:
-                        indices = node.thresholds[i] <= x_continuous[:,node.k]
-                    else:
-                        indices = (node.thresholds[i] <= x_continuous[:,node.k]) & (x_continuous[:,node.k] < node.thresholds[i+1])
-                    
-                    if np.any(indices):
-                        node.log_children_marginal_likelihood[i] = \
-                            self._update_posterior_recursion_batch(
-                                node.children[i],
-                                x_continuous[indices],
-                                x_categorical[indices],
-                                y[indices],
-                            )
-                    else:
-                        node.log_children_marginal_likelihood[i] = 0.0
+                bin_idx = np.searchsorted(node.thresholds[1:-1],x_continuous[:,node.k],side='right')
             else:
-                for i in range(self.c_num_children_vec[node.k]):
-                    indices = x_categorical[:,node.k-self.c_dim_continuous] == i
-                    if np.any(indices):
-                        node.log_children_marginal_likelihood[i] = \
-                            self._update_posterior_recursion_batch(
-                                node.children[i],
-                                x_continuous[indices],
-                                x_categorical[indices],
-                                y[indices],
-                            )
-                    else:
-                        node.log_children_marginal_likelihood[i] = 0.0
-            tmp1 = np.log(node.h_g) + node.log_children_marginal_likelihood.sum()
+                bin_idx = x_categorical[:,node.k-self.c_dim_continuous]
+            counts = np.bincount(bin_idx,minlength=self.c_num_children_vec[node.k])
+            for i in range(self.c_num_children_vec[node.k]):
+                if counts[i] == 0:
+                    node.log_children_marginal_likelihood[i] = 0.0
+                    continue
+                indices = bin_idx == i
+                node.log_children_marginal_likelihood[i] = \
+                    self._update_posterior_recursion_batch(
+                        node.children[i],
+                        x_continuous[indices],
+                        x_categorical[indices],
+                        y[indices],
+                    )
             node.log_marginal_likelihood = self._update_posterior_leaf_batch(node,y)
-            tmp2 = np.logaddexp(np.log(1 - node.h_g) + node.log_marginal_likelihood, tmp1)
-            node.h_g = np.exp(tmp1 - tmp2)
-            return tmp2
+            node.h_g, log_marginal_likelihood = _update_node_post(
+                node.h_g,node.log_marginal_likelihood,node.log_children_marginal_likelihood)
+            return log_marginal_likelihood
+
+    def _update_posterior_recursion_batch_binary(self,node:_Node,x_continuous,x_categorical,y):
+        if node.leaf:  # leaf node
+            node.log_marginal_likelihood = self._update_posterior_leaf_batch(node,y)
+            return node.log_marginal_likelihood
+        else:  # inner node
+            if node.k < self.c_dim_continuous:
+                indices = x_continuous[:,node.k] < node.thresholds[1]
+            else:
+                indices = x_categorical[:,node.k-self.c_dim_continuous] == 0
+            num_left = np.count_nonzero(indices)
+            if num_left > 0:
+                node.log_children_marginal_likelihood[0] = \
+                    self._update_posterior_recursion_batch_binary(
+                        node.children[0],
+                        x_continuous[indices],
+                        x_categorical[indices],
+                        y[indices],
+                    )
+            else:
+                node.log_children_marginal_likelihood[0] = 0.0
+            if num_left < indices.shape[0]:
+                np.logical_not(indices,out=indices)
+                node.log_children_marginal_likelihood[1] = \
+                    self._update_posterior_recursion_batch_binary(
+                        node.children[1],
+                        x_continuous[indices],
+                        x_categorical[indices],
+                        y[indices],
+                    )
+            else:
+                node.log_children_marginal_likelihood[1] = 0.0
+            node.log_marginal_likelihood = self._update_posterior_leaf_batch(node,y)
+            node.h_g, log_marginal_likelihood = _update_node_post(
+                node.h_g,node.log_marginal_likelihood,node.log_children_marginal_likelihood)
+            return log_marginal_likelihood
 
     def _update_posterior_leaf_lr_batch(self,node:_Node,x_continuous,y):
         node.sub_model._update_posterior(x_continuous,y)
@@ -1779,42 +1862,62 @@ class LearnModel(base.Posterior,base.PredictiveMixin):
             return node.log_marginal_likelihood
         else:  # inner node
             if node.k < self.c_dim_continuous:
-                for i in range(self.c_num_children_vec[node.k]):
-                    if i == 0:
-                        indices = x_continuous[:,node.k] < node.thresholds[i+1]
-                    elif i == self.c_num_children_vec[node.k]-1:
-                        indices = node.thresholds[i] <= x_continuous[:,node.k]
-                    else:
-                        indices = (node.thresholds[i] <= x_continuous[:,node.k]) & (x_continuous[:,node.k] < node.thresholds[i+1])
-                    
-                    if np.any(indices):
-                        node.log_children_marginal_likelihood[i] = \
-                            self._update_posterior_recursion_lr_batch(
-                                node.children[i],
-                                x_continuous[indices],
-                                x_categorical[indices],
-                                y[indices],
-                            )
-                    else:
-                        node.log_children_marginal_likelihood[i] = 0.0
+                bin_idx = np.searchsorted(node.thresholds[1:-1],x_continuous[:,node.k],side='right')
             else:
-                for i in range(self.c_num_children_vec[node.k]):
-                    indices = x_categorical[:,node.k-self.c_dim_continuous] == i
-                    if np.any(indices):
-                        node.log_children_marginal_likelihood[i] = \
-                            self._update_posterior_recursion_lr_batch(
-                                node.children[i],
-                                x_continuous[indices],
-                                x_categorical[indices],
-                                y[indices],
-                            )
-                    else:
-                        node.log_children_marginal_likelihood[i] = 0.0
-            tmp1 = np.log(node.h_g) + node.log_children_marginal_likelihood.sum()
+                bin_idx = x_categorical[:,node.k-self.c_dim_continuous]
+            counts = np.bincount(bin_idx,minlength=self.c_num_children_vec[node.k])
+            for i in range(self.c_num_children_vec[node.k]):
+                if counts[i] == 0:
+                    node.log_children_marginal_likelihood[i] = 0.0
+                    continue
+                indices = bin_idx == i
+                node.log_children_marginal_likelihood[i] = \
+                    self._update_posterior_recursion_lr_batch(
+                        node.children[i],
+                        x_continuous[indices],
+                        x_categorical[indices],
+                        y[indices],
+                    )
+            node.log_marginal_likelihood = self._update_posterior_leaf_lr_batch(node,x_continuous,y)
+            node.h_g, log_marginal_likelihood = _update_node_post(
+                node.h_g,node.log_marginal_likelihood,node.log_children_marginal_likelihood)
+            return log_marginal_likelihood
+
+    def _update_posterior_recursion_lr_batch_binary(self,node:_Node,x_continuous,x_categorical,y):
+        if node.leaf:  # leaf node
+            node.log_marginal_likelihood = self._update_posterior_leaf_lr_batch(node,x_continuous,y)
+            return node.log_marginal_likelihood
+        else:  # inner node
+            if node.k < self.c_dim_continuous:
+                indices = x_continuous[:,node.k] < node.thresholds[1]
+            else:
+                indices = x_categorical[:,node.k-self.c_dim_continuous] == 0
+            num_left = np.count_nonzero(indices)
+            if num_left > 0:
+                node.log_children_marginal_likelihood[0] = \
+                    self._update_posterior_recursion_lr_batch_binary(
+                        node.children[0],
+                        x_continuous[indices],
+                        x_categorical[indices],
+                        y[indices],
+                    )
+            else:
+                node.log_children_marginal_likelihood[0] = 0.0
+            if num_left < indices.shape[0]:
+                np.logical_not(indices,out=indices)
+                node.log_children_marginal_likelihood[1] = \
+                    self._update_posterior_recursion_lr_batch_binary(
+                        node.children[1],
+                        x_continuous[indices],
+                        x_categorical[indices],
+                        y[indices],
+                    )
+            else:
+                node.log_children_marginal_likelihood[1] = 0.0
             node.log_marginal_likelihood = self._update_posterior_leaf_lr_batch(node,x_continuous,y)
-            tmp2 = np.logaddexp(np.log(1 - node.h_g) + node.log_marginal_likelihood, tmp1)
-            node.h_g = np.exp(tmp1 - tmp2)
-            return tmp2
+            node.h_g, log_marginal_likelihood = _update_node_post(
+                node.h_g,node.log_marginal_likelihood,node.log_children_marginal_likelihood)
+            return log_marginal_likelihood
 
     def _compare_metatree_recursion(self,node1:_Node,node2:_Node):
         if node1.leaf:
@@ -1844,15 +1947,15 @@ class LearnModel(base.Posterior,base.PredictiveMixin):
     
     def _marge_metatrees(self,metatree_list,metatree_prob_vec):
         num_metatrees = len(metatree_list)
+        keep = [True]*num_metatrees
         for i in range(num_metatrees):
             for j in range(i+1,num_metatrees):
                 if self._compare_metatree_recursion(metatree_list[i],metatree_list[j]):
-                    metatree_list[i] = None
+                    keep[i] = False
                     metatree_prob_vec[j] += metatree_prob_vec[i]
-                    metatree_prob_vec[i] = -1
                     break
-        metatree_list = [tmp for tmp in metatree_list if tmp != None]
-        metatree_prob_vec = metatree_prob_vec[metatree_prob_vec > -0.5]
+        metatree_list = [tmp for tmp,kept in zip(metatree_list,keep) if kept]
+        metatree_prob_vec = metatree_prob_vec[np.fromiter(keep,dtype=bool,count=num_metatrees)]
         return metatree_list,metatree_prob_vec
 
     def _MTRF(self,x_continuous,x_categorical,y,n_estimators=100,**kwargs):
@@ -1906,9 +2009,7 @@ class LearnModel(base.Posterior,base.PredictiveMixin):
                 0,
                 self._root_k_candidates,
                 self.hn_g,
-                sub_model=self.SubModel.LearnModel(
-                    **self.sub_constants,
-                    **self.sub_h0_params).set_hn_params(**self.sub_hn_params),
+                sub_model=_clone_sub_model(self._template_sub_model),
                 ranges=self.c_ranges,
                 log_children_marginal_likelihood=np.zeros(2),
                 )
@@ -1945,11 +2046,17 @@ class LearnModel(base.Posterior,base.PredictiveMixin):
             raise(ParameterFormatError("given_MT is supported only when len(self.hn_metatree_list) > 0."))
         log_metatree_posteriors = np.log(self.hn_metatree_prob_vec)
         if self.SubModel is linearregression:
-            for i,metatree in enumerate(self.hn_metatree_list):
-                log_metatree_posteriors[i] += self._update_posterior_recursion_lr_batch(metatree,x_continuous,x_categorical,y)
+            if self._all_binary:
+                update_posterior_recursion = self._update_posterior_recursion_lr_batch_binary
+            else:
+                update_posterior_recursion = self._update_posterior_recursion_lr_batch
         else:
-            for i,metatree in enumerate(self.hn_metatree_list):
-                log_metatree_posteriors[i] += self._update_posterior_recursion_batch(metatree,x_continuous,x_categorical,y)
+            if self._all_binary:
+                update_posterior_recursion = self._update_posterior_recursion_batch_binary
+            else:
+                update_posterior_recursion = self._update_posterior_recursion_batch
+        for i,metatree in enumerate(self.hn_metatree_list):
+            log_metatree_posteriors[i] += update_posterior_recursion(metatree,x_continuous,x_categorical,y)
         self.hn_metatree_prob_vec[:] = np.exp(log_metatree_posteriors - log_metatree_posteriors.max())
         self.hn_metatree_prob_vec[:] /= self.hn_metatree_prob_vec.sum()
 
@@ -1969,12 +2076,13 @@ class LearnModel(base.Posterior,base.PredictiveMixin):
                 ParameterFormatError
                 )
             x_categorical = x_categorical.reshape([-1,self.c_dim_categorical])
-            for i in range(self.c_dim_categorical):
-                if x_categorical[:,i].max() >= self.c_num_children_vec[self.c_dim_continuous+i]:
-                    raise(DataFormatError(
-                        f"x_categorical[:,{i}].max() must smaller than "
-                        +f"self.c_num_children_vec[{self.c_dim_continuous+i}]: "
-                        +f"{self.c_num_children_vec[self.c_dim_continuous+i]}"))
+            over_max = x_categorical.max(axis=0) >= self.c_num_children_vec[self.c_dim_continuous:]
+            if over_max.any():
+                i = int(np.argmax(over_max))
+                raise(DataFormatError(
+                    f"x_categorical[:,{i}].max() must smaller than "
+                    +f"self.c_num_children_vec[{self.c_dim_continuous+i}]: "
+                    +f"{self.c_num_children_vec[self.c_dim_continuous+i]}"))
             _check.shape_consistency(
                 x_continuous.shape[0],'x_continuous.shape[0]',
                 x_categorical.shape[0],'x_categorical.shape[0]',
@@ -1999,12 +2107,13 @@ class LearnModel(base.Posterior,base.PredictiveMixin):
                 ParameterFormatError
                 )
             x_categorical = x_categorical.reshape([-1,self.c_dim_categorical])
-            for i in range(self.c_dim_categorical):
-                if x_categorical[:,i].max() >= self.c_num_children_vec[self.c_dim_continuous+i]:
-                    raise(DataFormatError(
-                        f"x_categorical[:,{i}].max() must smaller than "
-                        +f"self.c_num_children_vec[{self.c_dim_continuous+i}]: "
-                        +f"{self.c_num_children_vec[self.c_dim_continuous+i]}"))
+            over_max = x_categorical.max(axis=0) >= self.c_num_children_vec[self.c_dim_continuous:]
+            if over_max.any():
+                i = int(np.argmax(over_max))
+                raise(DataFormatError(
+                    f"x_categorical[:,{i}].max() must smaller than "
+                    +f"self.c_num_children_vec[{self.c_dim_continuous+i}]: "
+                    +f"{self.c_num_children_vec[self.c_dim_continuous+i]}"))
             x_continuous = np.empty([x_categorical.shape[0],0]) # dummy
 
         return x_continuous,x_categorical
@@ -2078,19 +2187,21 @@ class LearnModel(base.Posterior,base.PredictiveMixin):
             0,
             self._root_k_candidates,
             self.hn_g,
-            self.rng.choice(self._root_k_candidates),
-            sub_model=copy.deepcopy(self._hn_node_sub_model),
+            self._root_k_candidates[self.rng.integers(len(self._root_k_candidates))],
+            sub_model=_clone_sub_model(self._hn_node_sub_model),
             ranges=self.c_ranges,
             log_children_marginal_likelihood=np.zeros(self._num_children),
             )
         self._tmp_metatree_list = [self._tmp_root]
-        self._tmp_metatree_count_list = [1]
+        # self._tmp_metatree_count_vec[i] is the count of self._tmp_metatree_list[i]
+        self._tmp_metatree_count_vec = np.zeros(max(burn_in,1)+num_metatrees,dtype=int)
+        self._tmp_metatree_count_vec[0] = 1
         if self.SubModel is linearregression:
             self._l_last = self._generate_truncated_and_update_lr(None,self._tmp_root,True,x_continuous,x_categorical,y)
         else:
             self._l_last = self._generate_truncated_and_update(None,self._tmp_root,True,x_continuous,x_categorical,y)
         
-        if self.c_dim_features == 1:
+        if len(set(self._root_k_candidates)) < 2: # no other feature can be proposed in the MH steps
             return self._tmp_metatree_list, np.array([1])
 
         self._num_proposed = 1
@@ -2115,9 +2226,9 @@ class LearnModel(base.Posterior,base.PredictiveMixin):
                 y,
             )
             self._update_g_max()
-        print()
+        print(f'\r{self._num_proposed}(accepted:{self._num_accepted})')
         tmp = self._num_accepted-1
-        self._tmp_metatree_count_list[-1] = 1
+        self._tmp_metatree_count_vec[tmp] = 1
         print(f'burn_in + num_metatrees: {burn_in + num_metatrees}')
         while self._num_proposed < burn_in + num_metatrees:
             self._mh_step_truncated(
@@ -2125,10 +2236,10 @@ class LearnModel(base.Posterior,base.PredictiveMixin):
                 x_categorical,
                 y,
             )
-        print()
+        print(f'\r{self._num_proposed}(accepted:{self._num_accepted})')
         
         # output
-        _tmp_metatree_prob_vec = np.array(self._tmp_metatree_count_list[tmp:],dtype=float)
+        _tmp_metatree_prob_vec = self._tmp_metatree_count_vec[tmp:self._num_accepted].astype(float)
         _tmp_metatree_prob_vec /= _tmp_metatree_prob_vec.sum()
         return self._marge_metatrees(self._tmp_metatree_list[tmp:],_tmp_metatree_prob_vec)
 
@@ -2142,6 +2253,8 @@ class LearnModel(base.Posterior,base.PredictiveMixin):
             num_chains=8,
             g_max=0.9,
             beta_vec=None,
+            beta_min=None,
+            tune_beta=False,
             num_interval=10,
             num_exchange=4,
             threshold_type='1d_kmeans',
@@ -2189,8 +2302,8 @@ class LearnModel(base.Posterior,base.PredictiveMixin):
                     0,
                     self._root_k_candidates,
                     self.hn_g,
-                    self.rng.choice(self._root_k_candidates),
-                    sub_model=copy.deepcopy(self._hn_node_sub_model),
+                    self._root_k_candidates[self.rng.integers(len(self._root_k_candidates))],
+                    sub_model=_clone_sub_model(self._hn_node_sub_model),
                     ranges=self.c_ranges,
                     log_children_marginal_likelihood=np.zeros(self._num_children),
                 )
@@ -2205,7 +2318,7 @@ class LearnModel(base.Posterior,base.PredictiveMixin):
             for i in range(self._num_chains):
                 self._l_lasts[i] = self._generate_truncated_and_update(None,self._tmp_roots[i],True,x_continuous,x_categorical,y)
         
-        if self.c_dim_features == 1:
+        if len(set(self._root_k_candidates)) < 2: # no other feature can be proposed in the MH steps
             return self._tmp_metatree_lists[self._num_chains-1], np.array([1])
 
         self._g_max = g_max
@@ -2219,6 +2332,25 @@ class LearnModel(base.Posterior,base.PredictiveMixin):
                     'All the elements of beta_vec must be in [0,1] '
                     + f'beta_vec = {beta_vec}.'
                 ))
+        elif beta_min is not None:
+            beta_min = _check.pos_float(beta_min,'beta_min',ParameterFormatError)
+            if beta_min >= 1.0:
+                raise(ParameterFormatError(
+                    f'beta_min must be in (0,1). beta_min = {beta_min}.'
+                ))
+            if self._num_chains < 2:
+                raise(ParameterFormatError(
+                    f'beta_min requires num_chains >= 2. num_chains = {self._num_chains}.'
+                ))
+            self._beta_vec[:] = np.geomspace(beta_min,1.0,self._num_chains)
+        self._tune_beta_flag = bool(tune_beta)
+        if self._tune_beta_flag and (self._beta_vec[0] <= 0 or np.any(np.diff(self._beta_vec) <= 0)):
+            raise(ParameterFormatError(
+                'tune_beta=True requires 0 < beta_vec[0] < beta_vec[1] < ... . '
+                + f'beta_vec = {self._beta_vec}.'
+            ))
+        self._swap_proposed_vec = np.zeros(max(self._num_chains-1,0),dtype=int)
+        self._swap_accepted_vec = np.zeros(max(self._num_chains-1,0),dtype=int)
         self._num_interval = _check.pos_int(num_interval,'num_interval',ParameterFormatError)
         self._num_exchange = _check.pos_int(num_exchange,'num_exchange',ParameterFormatError)    
         self._exchange_list = []    
@@ -2233,7 +2365,10 @@ class LearnModel(base.Posterior,base.PredictiveMixin):
             )
             if self._num_chains > 1 and i % self._num_interval == 0:
                 self._replica_exchange_memory_efficient()
-            print(f'\r{i}', end='')
+                if self._tune_beta_flag and self._swap_proposed_vec.min() >= 10:
+                    self._tune_beta()
+            if i % _PROGRESS_INTERVAL == 0 or i == burn_in-1:
+                print(f'\r{i}', end='')
         print()
         tmp = len(self._tmp_metatree_count_lists[self._num_chains-1])-1
         for i in range(self._num_chains):
@@ -2247,7 +2382,8 @@ class LearnModel(base.Posterior,base.PredictiveMixin):
             )
             if self._num_chains > 1 and i % self._num_interval == 0:
                 self._replica_exchange_memory_efficient()
-            print(f'\r{i}', end='')
+            if i % _PROGRESS_INTERVAL == 0 or i == num_metatrees-1:
+                print(f'\r{i}', end='')
         print()
         
         # output
@@ -2263,87 +2399,81 @@ class LearnModel(base.Posterior,base.PredictiveMixin):
             x_continuous,
             x_categorical,
             y,
+            same_rows_node:_Node=None, # a node that has been updated by exactly the same rows
             ):
         # always
-        if flag:
-            new.sub_model=copy.deepcopy(self._hn_node_sub_model)
+        if flag and same_rows_node is not None:
+            new.sub_model = _clone_sub_model(same_rows_node.sub_model)
+            new.log_marginal_likelihood = same_rows_node.log_marginal_likelihood
+        elif flag:
+            new.sub_model=_clone_sub_model(self._hn_node_sub_model)
             new.sub_model._update_posterior(x_continuous,y)
             new.log_marginal_likelihood = new.sub_model.calc_log_marginal_likelihood()
         else:
-            new.sub_model = copy.deepcopy(last.sub_model)
+            new.sub_model = _clone_sub_model(last.sub_model)
             new.log_marginal_likelihood = last.log_marginal_likelihood
 
         # leaf node
+        if new.depth < self.c_max_depth: # x_min and x_max are reused for new.ranges
+            x_min = x_continuous.min(axis=0)
+            x_max = x_continuous.max(axis=0)
         if (new.depth == self.c_max_depth 
-            or (np.allclose(x_continuous,x_continuous[0]) 
-                and np.allclose(x_categorical,x_categorical[0]))):
+            or (_rows_close(x_continuous[0],x_min,x_max)
+                and _all_rows_close(x_categorical))):
             new.h_g = 0
             new.leaf = True
             return new.log_marginal_likelihood
 
         # inner node
         if flag:
-            new.k = self.rng.choice(new.k_candidates)
+            new.k = new.k_candidates[self.rng.integers(len(new.k_candidates))]
         elif self.rng.random() > min(last.h_g,self._g_max):
             flag = True
             last.division_flag = False
             new.division_flag = False
-            new.k = self.rng.choice([k for k in new.k_candidates if k != last.k])
+            # draw uniformly from new.k_candidates except last.k by rejection
+            new.k = last.k
+            while new.k == last.k:
+                new.k = new.k_candidates[self.rng.integers(len(new.k_candidates))]
         else:
             last.division_flag = True
             new.division_flag = True
             new.k = last.k
 
-        new.ranges[:,0] = x_continuous.min(axis=0)
-        new.ranges[:,1] = x_continuous.max(axis=0)
+        new.ranges[:,0] = x_min
+        new.ranges[:,1] = x_max
         self._make_children_for_mcmc(new,x_continuous)
 
         if new.k < self.c_dim_continuous:
-            for i in range(self._num_children):
-                if i == 0:
-                    indices = x_continuous[:,new.k] < new.thresholds[i+1]
-                elif i == self._num_children-1:
-                    indices = new.thresholds[i] <= x_continuous[:,new.k]
-                else:
-                    indices = (new.thresholds[i] <= x_continuous[:,new.k]) & (x_continuous[:,new.k] < new.thresholds[i+1])
-                
-                if np.any(indices):
-                    new.log_children_marginal_likelihood[i] = \
-                        self._generate_truncated_and_update_lr(
-                            None if flag else last.children[i],
-                            new.children[i],
-                            flag,
-                            x_continuous[indices],
-                            x_categorical[indices],
-                            y[indices],
-                        )
-                else:
-                    new.log_children_marginal_likelihood[i] = 0.0
-                    new.children[i].leaf = True
-                    new.children[i].log_marginal_likelihood = 0.0
-                    new.children[i].sub_model = copy.deepcopy(self._hn_node_sub_model)
+            bin_idx = np.searchsorted(new.thresholds[1:self._num_children],x_continuous[:,new.k],side='right')
         else:
-            for i in range(self._num_children):
-                indices = x_categorical[:,new.k-self.c_dim_continuous] == i
-                if np.any(indices):
-                    new.log_children_marginal_likelihood[i] = \
-                        self._generate_truncated_and_update_lr(
-                            None if flag else last.children[i],
-                            new.children[i],
-                            flag,
-                            x_continuous[indices],
-                            x_categorical[indices],
-                            y[indices],
-                        )
-                else:
-                    new.log_children_marginal_likelihood[i] = 0.0
-                    new.children[i].leaf = True
-                    new.children[i].log_marginal_likelihood = 0.0
-                    new.children[i].sub_model = copy.deepcopy(self._hn_node_sub_model)
-        tmp1 = np.log(new.h_g) + new.log_children_marginal_likelihood.sum()
-        tmp2 = np.logaddexp(np.log(1 - new.h_g) + new.log_marginal_likelihood, tmp1)
-        new.h_g = np.exp(tmp1 - tmp2)
-        return tmp2
+            bin_idx = x_categorical[:,new.k-self.c_dim_continuous]
+        order,bounds = _partition(bin_idx,self._num_children)
+        # gather once so that the rows of each child are a contiguous slice (a view)
+        x_continuous = x_continuous[order]
+        x_categorical = x_categorical[order]
+        y = y[order]
+        for i in range(self._num_children):
+            if bounds[i] < bounds[i+1]:
+                rows = slice(bounds[i],bounds[i+1])
+                new.log_children_marginal_likelihood[i] = \
+                    self._generate_truncated_and_update_lr(
+                        None if flag else last.children[i],
+                        new.children[i],
+                        flag,
+                        x_continuous[rows],
+                        x_categorical[rows],
+                        y[rows],
+                        new if bounds[i+1] - bounds[i] == y.shape[0] else None,
+                    )
+            else:
+                new.log_children_marginal_likelihood[i] = 0.0
+                new.children[i].leaf = True
+                new.children[i].log_marginal_likelihood = 0.0
+                new.children[i].sub_model = _clone_sub_model(self._hn_node_sub_model)
+        new.h_g, log_marginal_likelihood = _update_node_post(
+            new.h_g,new.log_marginal_likelihood,new.log_children_marginal_likelihood)
+        return log_marginal_likelihood
 
     def _generate_truncated_and_update(
             self,
@@ -2353,95 +2483,89 @@ class LearnModel(base.Posterior,base.PredictiveMixin):
             x_continuous,
             x_categorical,
             y,
+            same_rows_node:_Node=None, # a node that has been updated by exactly the same rows
             ):
         # always
-        if flag:
-            new.sub_model=copy.deepcopy(self._hn_node_sub_model)
+        if flag and same_rows_node is not None:
+            new.sub_model = _clone_sub_model(same_rows_node.sub_model)
+            new.log_marginal_likelihood = same_rows_node.log_marginal_likelihood
+        elif flag:
+            new.sub_model=_clone_sub_model(self._hn_node_sub_model)
             new.sub_model._update_posterior(y)
             new.log_marginal_likelihood = new.sub_model.calc_log_marginal_likelihood()
         else:
-            new.sub_model = copy.deepcopy(last.sub_model)
+            new.sub_model = _clone_sub_model(last.sub_model)
             new.log_marginal_likelihood = last.log_marginal_likelihood
 
         # leaf node
+        if new.depth < self.c_max_depth: # x_min and x_max are reused for new.ranges
+            x_min = x_continuous.min(axis=0)
+            x_max = x_continuous.max(axis=0)
         if (new.depth == self.c_max_depth 
-            or (np.allclose(x_continuous,x_continuous[0]) 
-                and np.allclose(x_categorical,x_categorical[0]))):
+            or (_rows_close(x_continuous[0],x_min,x_max)
+                and _all_rows_close(x_categorical))):
             new.h_g = 0
             new.leaf = True
             return new.log_marginal_likelihood
 
         # inner node
         if flag:
-            new.k = self.rng.choice(new.k_candidates)
+            new.k = new.k_candidates[self.rng.integers(len(new.k_candidates))]
         elif self.rng.random() > min(last.h_g,self._g_max):
             flag = True
             last.division_flag = False
             new.division_flag = False
-            new.k = self.rng.choice([k for k in new.k_candidates if k != last.k])
+            # draw uniformly from new.k_candidates except last.k by rejection
+            new.k = last.k
+            while new.k == last.k:
+                new.k = new.k_candidates[self.rng.integers(len(new.k_candidates))]
         else:
             last.division_flag = True
             new.division_flag = True
             new.k = last.k
 
-        new.ranges[:,0] = x_continuous.min(axis=0)
-        new.ranges[:,1] = x_continuous.max(axis=0)
+        new.ranges[:,0] = x_min
+        new.ranges[:,1] = x_max
         self._make_children_for_mcmc(new,x_continuous)
 
         if new.k < self.c_dim_continuous:
-            for i in range(self._num_children):
-                if i == 0:
-                    indices = x_continuous[:,new.k] < new.thresholds[i+1]
-                elif i == self._num_children-1:
-                    indices = new.thresholds[i] <= x_continuous[:,new.k]
-                else:
-                    indices = (new.thresholds[i] <= x_continuous[:,new.k]) & (x_continuous[:,new.k] < new.thresholds[i+1])
-                
-                if np.any(indices):
-                    new.log_children_marginal_likelihood[i] = \
-                        self._generate_truncated_and_update(
-                            None if flag else last.children[i],
-                            new.children[i],
-                            flag,
-                            x_continuous[indices],
-                            x_categorical[indices],
-                            y[indices],
-                        )
-                else:
-                    new.log_children_marginal_likelihood[i] = 0.0
-                    new.children[i].leaf = True
-                    new.children[i].log_marginal_likelihood = 0.0
-                    new.children[i].sub_model = copy.deepcopy(self._hn_node_sub_model)
+            bin_idx = np.searchsorted(new.thresholds[1:self._num_children],x_continuous[:,new.k],side='right')
         else:
-            for i in range(self._num_children):
-                indices = x_categorical[:,new.k-self.c_dim_continuous] == i
-                if np.any(indices):
-                    new.log_children_marginal_likelihood[i] = \
-                        self._generate_truncated_and_update(
-                            None if flag else last.children[i],
-                            new.children[i],
-                            flag,
-                            x_continuous[indices],
-                            x_categorical[indices],
-                            y[indices],
-                        )
-                else:
-                    new.log_children_marginal_likelihood[i] = 0.0
-                    new.children[i].leaf = True
-                    new.children[i].log_marginal_likelihood = 0.0
-                    new.children[i].sub_model = copy.deepcopy(self._hn_node_sub_model)
-        tmp1 = np.log(new.h_g) + new.log_children_marginal_likelihood.sum()
-        tmp2 = np.logaddexp(np.log(1 - new.h_g) + new.log_marginal_likelihood, tmp1)
-        new.h_g = np.exp(tmp1 - tmp2)
-        return tmp2
+            bin_idx = x_categorical[:,new.k-self.c_dim_continuous]
+        order,bounds = _partition(bin_idx,self._num_children)
+        # gather once so that the rows of each child are a contiguous slice (a view)
+        x_continuous = x_continuous[order]
+        x_categorical = x_categorical[order]
+        y = y[order]
+        for i in range(self._num_children):
+            if bounds[i] < bounds[i+1]:
+                rows = slice(bounds[i],bounds[i+1])
+                new.log_children_marginal_likelihood[i] = \
+                    self._generate_truncated_and_update(
+                        None if flag else last.children[i],
+                        new.children[i],
+                        flag,
+                        x_continuous[rows],
+                        x_categorical[rows],
+                        y[rows],
+                        new if bounds[i+1] - bounds[i] == y.shape[0] else None,
+                    )
+            else:
+                new.log_children_marginal_likelihood[i] = 0.0
+                new.children[i].leaf = True
+                new.children[i].log_marginal_likelihood = 0.0
+                new.children[i].sub_model = _clone_sub_model(self._hn_node_sub_model)
+        new.h_g, log_marginal_likelihood = _update_node_post(
+            new.h_g,new.log_marginal_likelihood,new.log_children_marginal_likelihood)
+        return log_marginal_likelihood
 
     def _mh_step_truncated(self,x_continuous,x_categorical,y):
         self._tmp_root = _Node(
             0,
             self._root_k_candidates,
             self.hn_g,
-            self.rng.choice(self._root_k_candidates),
-            sub_model=copy.deepcopy(self._hn_node_sub_model),
+            self._root_k_candidates[self.rng.integers(len(self._root_k_candidates))],
+            sub_model=_clone_sub_model(self._hn_node_sub_model),
             ranges=self.c_ranges,
             log_children_marginal_likelihood=np.zeros(self._num_children),
             )
@@ -2468,10 +2592,10 @@ class LearnModel(base.Posterior,base.PredictiveMixin):
         _t_posteror_new = self._calc_truncated_posterior_lean(self._tmp_root)
         _t_posteror_last = self._calc_truncated_posterior_lean(self._tmp_metatree_list[-1])
 
-        if self.rng.random() < np.exp(_l_new-_t_posteror_last-self._l_last+_t_posteror_new):
+        if _log(self.rng.random()) < _l_new-_t_posteror_last-self._l_last+_t_posteror_new:
             # accept
             self._tmp_metatree_list.append(self._tmp_root)
-            self._tmp_metatree_count_list.append(1)
+            self._tmp_metatree_count_vec[self._num_accepted] = 1
             self._l_last = _l_new
             self._l_list.append(_l_new)
             self._num_proposed += 1
@@ -2480,74 +2604,35 @@ class LearnModel(base.Posterior,base.PredictiveMixin):
             self._numerator += 1
             self._denominator *= self._rho
             self._denominator += 1
-            print(f'\r{self._num_proposed}(accepted:{self._num_accepted})', end='')
+            if self._num_proposed % _PROGRESS_INTERVAL == 0:
+                print(f'\r{self._num_proposed}(accepted:{self._num_accepted})', end='')
         else:
             # reject
-            self._tmp_metatree_count_list[-1] += 1
+            self._tmp_metatree_count_vec[self._num_accepted-1] += 1
             self._l_list.append(self._l_last)
             self._num_proposed += 1
             self._numerator *= self._rho
             self._denominator *= self._rho
             self._denominator += 1
-            print(f'\r{self._num_proposed}(accepted:{self._num_accepted})', end='')
+            if self._num_proposed % _PROGRESS_INTERVAL == 0:
+                print(f'\r{self._num_proposed}(accepted:{self._num_accepted})', end='')
 
-    def _remh_step_truncated_memory_efficient(self,x_continuous,x_categorical,y):
-        for i in range(self._num_chains-1):
-            self._tmp_roots[i] = _Node(
-                0,
-                self._root_k_candidates,
-                self.hn_g,
-                self.rng.choice(self._root_k_candidates),
-                sub_model=copy.deepcopy(self._hn_node_sub_model),
-                ranges=self.c_ranges,
-                log_children_marginal_likelihood=np.zeros(self._num_children),
-            )
-
-            if self.SubModel is linearregression:
-                _l_new = self._generate_truncated_and_update_lr(
-                    self._tmp_metatree_lists[i][-1],
-                    self._tmp_roots[i],
-                    False,
-                    x_continuous,
-                    x_categorical,
-                    y,
-                )
-            else:
-                _l_new = self._generate_truncated_and_update(
-                    self._tmp_metatree_lists[i][-1],
-                    self._tmp_roots[i],
-                    False,
-                    x_continuous,
-                    x_categorical,
-                    y,
-                )
-
-            _t_posteror_new = self._calc_truncated_posterior_lean(self._tmp_roots[i])
-            _t_posteror_last = self._calc_truncated_posterior_lean(self._tmp_metatree_lists[i][-1])
-
-            if self.rng.random() < np.exp((_l_new-self._l_lasts[i])*self._beta_vec[i]-_t_posteror_last+_t_posteror_new):
-                # accept
-                self._tmp_metatree_lists[i][-1] = self._tmp_roots[i]
-                self._tmp_metatree_count_lists[i][-1] = 1
-                self._l_lasts[i] = _l_new
-            else:
-                # reject
-                self._tmp_metatree_count_lists[i][-1] += 1
-
-        self._tmp_roots[-1] = _Node(
+    def _remh_propose_truncated(self,i,x_continuous,x_categorical,y):
+        # proposes a new metatree for the i-th chain and returns whether it is accepted
+        self._tmp_roots[i] = _Node(
             0,
             self._root_k_candidates,
             self.hn_g,
-            self.rng.choice(self._root_k_candidates),
-            sub_model=copy.deepcopy(self._hn_node_sub_model),
+            self._root_k_candidates[self.rng.integers(len(self._root_k_candidates))],
+            sub_model=_clone_sub_model(self._hn_node_sub_model),
             ranges=self.c_ranges,
             log_children_marginal_likelihood=np.zeros(self._num_children),
         )
 
         if self.SubModel is linearregression:
             _l_new = self._generate_truncated_and_update_lr(
-                self._tmp_metatree_lists[-1][-1],
-                self._tmp_roots[-1],
+                self._tmp_metatree_lists[i][-1],
+                self._tmp_roots[i],
                 False,
                 x_continuous,
                 x_categorical,
@@ -2555,22 +2640,37 @@ class LearnModel(base.Posterior,base.PredictiveMixin):
             )
         else:
             _l_new = self._generate_truncated_and_update(
-                self._tmp_metatree_lists[-1][-1],
-                self._tmp_roots[-1],
+                self._tmp_metatree_lists[i][-1],
+                self._tmp_roots[i],
                 False,
                 x_continuous,
                 x_categorical,
                 y,
             )
 
-        _t_posteror_new = self._calc_truncated_posterior_lean(self._tmp_roots[-1])
-        _t_posteror_last = self._calc_truncated_posterior_lean(self._tmp_metatree_lists[-1][-1])
+        _t_posteror_new = self._calc_truncated_posterior_lean(self._tmp_roots[i])
+        _t_posteror_last = self._calc_truncated_posterior_lean(self._tmp_metatree_lists[i][-1])
+
+        if _log(self.rng.random()) < (_l_new-self._l_lasts[i])*self._beta_vec[i]-_t_posteror_last+_t_posteror_new:
+            self._l_lasts[i] = _l_new
+            return True
+        return False
+
+    def _remh_step_truncated_memory_efficient(self,x_continuous,x_categorical,y):
+        for i in range(self._num_chains-1):
+            if self._remh_propose_truncated(i,x_continuous,x_categorical,y):
+                # accept
+                self._tmp_metatree_lists[i][-1] = self._tmp_roots[i]
+                self._tmp_metatree_count_lists[i][-1] = 1
+            else:
+                # reject
+                self._tmp_metatree_count_lists[i][-1] += 1
 
-        if self.rng.random() < np.exp((_l_new-self._l_lasts[-1])*self._beta_vec[-1]-_t_posteror_last+_t_posteror_new):
+        # only the last chain keeps its history
+        if self._remh_propose_truncated(-1,x_continuous,x_categorical,y):
             # accept
             self._tmp_metatree_lists[-1].append(self._tmp_roots[-1])
             self._tmp_metatree_count_lists[-1].append(1)
-            self._l_lasts[-1] = _l_new
         else:
             # reject
             self._tmp_metatree_count_lists[-1][-1] += 1
@@ -2579,14 +2679,14 @@ class LearnModel(base.Posterior,base.PredictiveMixin):
 
     def _replica_exchange_memory_efficient(self):
         self._exchange_list.append(-1)
-        for i in range(self._num_exchange):
-            j = self.rng.choice(self._num_chains-1)
-            if self.rng.random() < np.exp(
-                    self._l_lasts[j]*self._beta_vec[j+1]
-                    +self._l_lasts[j+1]*self._beta_vec[j]
-                    -self._l_lasts[j]*self._beta_vec[j]
-                    -self._l_lasts[j+1]*self._beta_vec[j+1]
-                ):
+        # the pairs are drawn at once, but they are exchanged in turn
+        # because an exchange changes self._l_lasts for the following pairs
+        j_vec = self.rng.integers(self._num_chains-1,size=self._num_exchange)
+        log_u_vec = np.log(self.rng.random(self._num_exchange))
+        np.add.at(self._swap_proposed_vec,j_vec,1)
+        for j,log_u in zip(j_vec.tolist(),log_u_vec.tolist()):
+            if log_u < (self._l_lasts[j]-self._l_lasts[j+1])*(self._beta_vec[j+1]-self._beta_vec[j]):
+                self._swap_accepted_vec[j] += 1
                 if j == self._num_chains-2:
                     self._exchange_list.append(j)
                     self._tmp_metatree_lists[j+1].append(self._tmp_metatree_lists[j][-1])
@@ -2609,16 +2709,37 @@ class LearnModel(base.Posterior,base.PredictiveMixin):
                     self._l_lasts[j] = self._l_lasts[j+1]
                     self._l_lasts[j+1] = tmp
 
+    def _tune_beta(self):
+        # rescales the gaps of log(beta) between adjacent replicas by their swap acceptance rates
+        # so that the rates become equal, keeping the first and the last beta fixed
+        accept_rate_vec = (self._swap_accepted_vec + 1.0) / (self._swap_proposed_vec + 2.0)
+        log_beta_vec = np.log(self._beta_vec)
+        log_gap_vec = np.diff(log_beta_vec) * accept_rate_vec
+        log_gap_vec *= (log_beta_vec[-1] - log_beta_vec[0]) / log_gap_vec.sum()
+        self._beta_vec[1:-1] = np.exp(log_beta_vec[0] + np.cumsum(log_gap_vec[:-1]))
+        self._swap_proposed_vec[:] = 0
+        self._swap_accepted_vec[:] = 0
+
     def _calc_truncated_posterior_lean(self,node:_Node):
-        if node.k is None:
-            return 0.0
-        elif node.division_flag:
-            tmp = 0
-            for i in range(self._num_children):
-                tmp += self._calc_truncated_posterior_lean(node.children[i])
-            return np.log(min(node.h_g,self._g_max)) + tmp
-        else:
-            return np.log(1.0-min(node.h_g,self._g_max))
+        # the last metatree is evaluated at every step, so the logs are cached on its nodes
+        g_max = self._g_max
+        log_posterior = 0.0
+        stack = [node]
+        while stack:
+            node = stack.pop()
+            if node.k is None:
+                continue
+            if node._truncated_g_max != g_max:
+                g = min(node.h_g,g_max)
+                node._log_g = _log(g)
+                node._log_not_g = _log1p(-g)
+                node._truncated_g_max = g_max
+            if node.division_flag:
+                log_posterior += node._log_g
+                stack.extend(node.children)
+            else:
+                log_posterior += node._log_not_g
+        return log_posterior
 
     def _update_g_max(self):
         p_hat = self._numerator / self._denominator
@@ -2634,9 +2755,7 @@ class LearnModel(base.Posterior,base.PredictiveMixin):
         self._g_list.append(self._g_max)
 
     def _make_children_for_mcmc(self,node:_Node,x):
-        child_k_candidates = node.k_candidates.copy()
-        if self.c_num_assignment_vec[node.k] > 0:
-            child_k_candidates.remove(node.k)
+        child_k_candidates = _child_k_candidates(node,self.c_num_assignment_vec)
         if node.k < self.c_dim_continuous:
             if node.ranges[node.k,0] == node.ranges[node.k,1]:
                 node.thresholds = np.ones(self._num_children+1) * node.ranges[node.k,0]
@@ -2762,7 +2881,20 @@ class LearnModel(base.Posterior,base.PredictiveMixin):
 
                 Temperature parameters for replica exchange Monte Carlo methods, 
                 by default None. It must satisfy $0 \\leq \\beta_1 < \\beta_2 < \\cdots < \\beta_J = 1$.
-                If None, $\\beta_j = j/J$. See also Appendix D in [2].
+                If None and ``beta_min`` is None, $\\beta_j = j/J$. See also Appendix D in [2].
+
+              * beta_min : {None, float}
+
+                The smallest temperature parameter of a geometric ladder, by default None. 
+                If a float in (0,1) is given and ``beta_vec`` is None, 
+                $\\beta_j = \\beta_\\mathrm{min}^{(J-j)/(J-1)}$. 
+                It requires ``num_chains`` $J \\geq 2$.
+
+              * tune_beta : bool
+
+                If True, $\\beta_2,\\dots,\\beta_{J-1}$ are tuned in burn-in phase 
+                so that the acceptance rates of replica exchanges between adjacent replicas 
+                become equal, by default False. $\\beta_1$ must be positive.
 
               * num_interval : int
 
@@ -2817,64 +2949,76 @@ class LearnModel(base.Posterior,base.PredictiveMixin):
                 = self._REMTMCMC(x_continuous,x_categorical,y,**kwargs)
         return self
 
-    def _map_recursion_add_nodes(self,node:_Node):
-        if node.depth == self.c_max_depth or not node.k_candidates:  # leaf node
-            node.h_g = 0.0
-            node.sub_model = self.SubModel.LearnModel(
-                **self.sub_constants,
-                **self.sub_h0_params).set_hn_params(**self.sub_hn_params)
-            node.leaf = True
-            node.map_leaf = True
-        else:  # inner node
-            node.k = node.k_candidates[self.hn_k_weight_vec[node.k_candidates].argmax()]
-            node.children = [None for i in range(self.c_num_children_vec[node.k])]
-            if node.k < self.c_dim_continuous:
-                node.thresholds = np.linspace(
-                    node.ranges[node.k,0],
-                    node.ranges[node.k,1],
-                    self.c_num_children_vec[node.k]+1
-                    )
+    def _map_recursion_add_nodes(self,root:_Node):
+        c_max_depth = self.c_max_depth
+        c_dim_continuous = self.c_dim_continuous
+        c_num_children_vec = self.c_num_children_vec
+        c_num_assignment_vec = self.c_num_assignment_vec
+        hn_k_weight_vec = self.hn_k_weight_vec
+        hn_g = self.hn_g
+        stack = [root]
+        while stack:
+            node = stack.pop()
+            if node.depth == c_max_depth or not node.k_candidates:  # leaf node
+                node.h_g = 0.0
+                node.sub_model = _clone_sub_model(self._template_sub_model)
+                node.leaf = True
+                node.map_leaf = True
+                continue
+            # inner node
+            node.k = node.k_candidates[hn_k_weight_vec[node.k_candidates].argmax()]
+            num_children = c_num_children_vec[node.k]
+            node.children = [None for i in range(num_children)]
+            if node.k < c_dim_continuous:
+                node.thresholds = (node.ranges[node.k,0]
+                                   + (node.ranges[node.k,1]-node.ranges[node.k,0]) * self._unit_grid[num_children])
             else:
                 node.thresholds = None
-            child_k_candidates = node.k_candidates.copy()
-            if self.c_num_assignment_vec[node.k] > 0:
-                child_k_candidates.remove(node.k)
+            child_k_candidates = _child_k_candidates(node,c_num_assignment_vec)
             # node.leaf = False # To distinguish the leaf with no sample from map leaf, node.leaf must be left as it is.
-            for i in range(self.c_num_children_vec[node.k]):
+            for i in range(num_children):
                 node.children[i] = _Node(
                     node.depth+1,
                     child_k_candidates,
-                    self.hn_g,
-                    ranges=np.array(node.ranges)
+                    hn_g,
+                    ranges=node.ranges.copy()
                     )
                 if node.thresholds is not None:
                     node.children[i].ranges[node.k,0] = node.thresholds[i]
                     node.children[i].ranges[node.k,1] = node.thresholds[i+1]
-                self._map_recursion_add_nodes(node.children[i])
+            stack.extend(node.children)
 
-    def _map_recursion(self,node:_Node):
+    def _map_recursion(self,node:_Node,hn_g_pow_dict,add_nodes=True):
+        # hn_g_pow_dict caches hn_g ** (sum_nodes-1) for each (depth, k_candidates) of the leaves
+        # If add_nodes is False, only the probability is returned and the leaves are not expanded.
         if node.leaf:
             if node.depth == self.c_max_depth or not node.k_candidates:
                 node.map_leaf = True
                 return 1.0
             else:
-                sum_nodes = 0
-                num_nodes = 1
-                rest_num_children_vec = np.sort(self.c_num_children_vec[node.k_candidates])
-                for i in range(min(self.c_max_depth-node.depth,len(node.k_candidates))):
-                    sum_nodes += num_nodes
-                    num_nodes *= rest_num_children_vec[i]
-                if 1.0 - node.h_g > node.h_g * self.hn_g ** (sum_nodes-1):
+                key = (node.depth,tuple(node.k_candidates))
+                hn_g_pow = hn_g_pow_dict.get(key)
+                if hn_g_pow is None:
+                    sum_nodes = 0
+                    num_nodes = 1
+                    rest_num_children_vec = np.sort(self.c_num_children_vec[node.k_candidates])
+                    for i in range(min(self.c_max_depth-node.depth,len(node.k_candidates))):
+                        sum_nodes += num_nodes
+                        num_nodes *= rest_num_children_vec[i]
+                    hn_g_pow = self.hn_g ** (sum_nodes-1)
+                    hn_g_pow_dict[key] = hn_g_pow
+                if 1.0 - node.h_g > node.h_g * hn_g_pow:
                     node.map_leaf = True
                     return 1.0 - node.h_g
                 else:
-                    self._map_recursion_add_nodes(node)
-                    return node.h_g * self.hn_g ** (sum_nodes-1)
+                    if add_nodes:
+                        self._map_recursion_add_nodes(node)
+                    return node.h_g * hn_g_pow
         else:
             tmp1 = 1.0-node.h_g
             tmp2 = node.h_g
             for i in range(self.c_num_children_vec[node.k]):
-                tmp2 *= self._map_recursion(node.children[i])
+                tmp2 *= self._map_recursion(node.children[i],hn_g_pow_dict,add_nodes)
             if tmp1 > tmp2:
                 node.map_leaf = True
                 return tmp1
@@ -2882,32 +3026,36 @@ class LearnModel(base.Posterior,base.PredictiveMixin):
                 node.map_leaf = False
                 return tmp2
 
-    def _copy_map_tree_recursion(self,copied_node:_Node,original_node:_Node):
-        copied_node.h_g = original_node.h_g
-        if original_node.map_leaf:
-            copied_node.sub_model = copy.deepcopy(original_node.sub_model)
-            copied_node.leaf = True
-        else:
+    def _copy_map_tree_recursion(self,copied_root:_Node,original_root:_Node):
+        c_dim_continuous = self.c_dim_continuous
+        c_num_children_vec = self.c_num_children_vec
+        c_num_assignment_vec = self.c_num_assignment_vec
+        stack = [(copied_root,original_root)]
+        while stack:
+            copied_node,original_node = stack.pop()
+            copied_node.h_g = original_node.h_g
+            if original_node.map_leaf:
+                copied_node.sub_model = _clone_sub_model(original_node.sub_model)
+                copied_node.leaf = True
+                continue
             copied_node.k = original_node.k
-            copied_node.children = [None for i in range(self.c_num_children_vec[copied_node.k])]
-            if copied_node.k < self.c_dim_continuous:
-                copied_node.thresholds = np.array(original_node.thresholds)
+            copied_node.children = [None for i in range(c_num_children_vec[copied_node.k])]
+            if copied_node.k < c_dim_continuous:
+                copied_node.thresholds = original_node.thresholds.copy()
             else:
                 copied_node.thresholds = None
-            child_k_candidates = copied_node.k_candidates.copy()
-            if self.c_num_assignment_vec[copied_node.k] > 0:
-                child_k_candidates.remove(copied_node.k)
+            child_k_candidates = _child_k_candidates(copied_node,c_num_assignment_vec)
             copied_node.leaf = False
-            for i in range(self.c_num_children_vec[copied_node.k]):
+            for i in range(c_num_children_vec[copied_node.k]):
                 copied_node.children[i] = _Node(
                     copied_node.depth+1,
                     child_k_candidates,
-                    ranges=np.array(copied_node.ranges),
+                    ranges=copied_node.ranges.copy(),
                     )
                 if copied_node.thresholds is not None:
                     copied_node.children[i].ranges[copied_node.k,0] = copied_node.thresholds[i]
                     copied_node.children[i].ranges[copied_node.k,1] = copied_node.thresholds[i+1]
-                self._copy_map_tree_recursion(copied_node.children[i],original_node.children[i])
+            stack.extend(zip(copied_node.children,original_node.children))
 
     def estimate_params(self,loss="0-1",visualize=True,filename=None,format=None):
         r"""Estimate the parameter under the given criterion.
@@ -2949,6 +3097,7 @@ class LearnModel(base.Posterior,base.PredictiveMixin):
         if loss == "0-1":
             map_index = 0
             map_prob = -1.0
+            hn_g_pow_dict = {}
             map_root = _Node(
                 0,
                 self._root_k_candidates,
@@ -2957,30 +3106,32 @@ class LearnModel(base.Posterior,base.PredictiveMixin):
                 leaf=True,
                 )
             if self.hn_metatree_list:
-                for i,metatree in enumerate(self.hn_metatree_list):
-                    prob = self.hn_metatree_prob_vec[i] * self._map_recursion(metatree)
-                    if prob > map_prob:
+                # _map_recursion returns at most 1.0, so the meta-trees are visited in descending order of 
+                # hn_metatree_prob_vec and the rest are skipped once it cannot exceed map_prob.
+                for i in np.argsort(-self.hn_metatree_prob_vec,kind='stable'):
+                    if self.hn_metatree_prob_vec[i] < map_prob:
+                        break
+                    prob = self.hn_metatree_prob_vec[i] * self._map_recursion(self.hn_metatree_list[i],hn_g_pow_dict,False)
+                    if prob > map_prob or (prob == map_prob and i < map_index): # the first one is taken in case of a tie
                         map_index = i
                         map_prob = prob
+                # only the MAP meta-tree is expanded
+                self._map_recursion(self.hn_metatree_list[map_index],hn_g_pow_dict)
                 self._copy_map_tree_recursion(map_root,self.hn_metatree_list[map_index])
             else:
                 warnings.warn(
                     "self.hn_metatree_list is empty. "
                     +"Therefore, one of the most likely model tree will be returned.",
                     ResultWarning)
-                self._map_recursion(map_root)
+                self._map_recursion(map_root,hn_g_pow_dict)
             if visualize:
                 import graphviz
                 tree_graph = graphviz.Digraph(filename=filename,format=format)
                 tree_graph.attr("node",shape="box",fontname="helvetica",style="rounded,filled")
-                self._visualize_model_recursion(
+                self._visualize_metatree(
                     tree_graph,
                     map_root,
                     0,
-                    None,
-                    None,
-                    None,
-                    1.0,
                     map_prob,
                     True,
                     False,
@@ -2991,136 +3142,112 @@ class LearnModel(base.Posterior,base.PredictiveMixin):
             raise(CriteriaError("Unsupported loss function! "
                                 +"This function supports only \"0-1\"."))
     
-    def _visualize_model_recursion(self,tree_graph,node:_Node,node_id,parent_id,parent_k,sibling_num,p_s,approx_posterior,map_tree,h_params):
-        tmp_id = node_id
-        tmp_p_s = p_s
-
-        # add node information
-        if node.leaf:
-            label_string = 'k=None\\l'
-        else:
-            label_string = f'k={node.k}\\l'
-            if node.k < self.c_dim_continuous:
-                label_string += f'thresholds=\\l{np.array2string(node.thresholds[1:-1],precision=2)}\\l'
-        label_string += f'hn_g={node.h_g:.2f}\\lp_s={tmp_p_s:.2f}\\l'
-        if node.sub_model is not None:
-            if h_params:
-                label_string += 'sub_hn_params={'
-                sub_params = node.sub_model.get_hn_params()
+    def _visualize_metatree(self,tree_graph,root:_Node,node_id,approx_posterior,map_tree,h_params,sub_params=None):
+        # The nodes are numbered from node_id in depth-first order. The last number is returned.
+        # If sub_params is given, it is shown at every node instead of the parameters of node.sub_model.
+        c_dim_continuous = self.c_dim_continuous
+        c_num_children_vec = self.c_num_children_vec
+        c_ranges = self.c_ranges
+        node_id -= 1
+        stack = [(root,None,None,None,1.0)]
+        while stack:
+            node,parent_id,parent_k,sibling_num,p_s = stack.pop()
+            node_id += 1
+
+            # add node information
+            if node.leaf:
+                label_string = 'k=None\\l'
             else:
-                label_string += 'sub_params={'
-                try:
-                    sub_params = node.sub_model.estimate_params(loss='0-1',dict_out=True)
-                except:
-                    sub_params = node.sub_model.estimate_params(dict_out=True)
+                label_string = f'k={node.k}\\l'
+                if node.k < c_dim_continuous:
+                    label_string += f'thresholds=\\l{np.array2string(node.thresholds[1:-1],precision=2)}\\l'
+            label_string += f'hn_g={node.h_g:.2f}\\lp_s={p_s:.2f}\\l'
+            if sub_params is not None or node.sub_model is not None:
+                if h_params:
+                    label_string += 'sub_hn_params={'
+                else:
+                    label_string += 'sub_params={'
+                if sub_params is not None:
+                    node_sub_params = sub_params
+                elif h_params:
+                    node_sub_params = node.sub_model.get_hn_params()
+                else:
+                    try:
+                        node_sub_params = node.sub_model.estimate_params(loss='0-1',dict_out=True)
+                    except:
+                        node_sub_params = node.sub_model.estimate_params(dict_out=True)
 
-            for key,value in sub_params.items():
-                try:
-                    label_string += f'\\l{key}:{value:.2f}'
-                except:
+                for key,value in node_sub_params.items():
                     try:
-                        label_string += f'\\l{key}:{np.array2string(value,precision=2,max_line_width=1)}'
+                        label_string += f'\\l{key}:{value:.2f}'
                     except:
-                        label_string += f'\\l{key}:{value}'
-            label_string += '}\\l'
-        else:
-            label_string += 'sub_model=\\lNone\\l'
-            
-        tree_graph.node(name=f'{tmp_id}',label=label_string,fillcolor=f'{rgb2hex(_CMAP(tmp_p_s))}')
-        if tmp_p_s > 0.65:
-            tree_graph.node(name=f'{tmp_id}',fontcolor='white')
-        
-        # add edge information
-        if parent_id is not None:
-            if parent_k < self.c_dim_continuous:
-                if node.ranges[parent_k,0] <= self.c_ranges[parent_k,0] + 1.0E-8:
-                    tree_graph.edge(f'{parent_id}', f'{tmp_id}', label=f'[*,{node.ranges[parent_k,1]:.2f})')
-                elif node.ranges[parent_k,1] >= self.c_ranges[parent_k,1] - 1.0E-8:
-                    tree_graph.edge(f'{parent_id}', f'{tmp_id}', label=f'[{node.ranges[parent_k,0]:.2f},*)')
-                else:
-                    tree_graph.edge(f'{parent_id}', f'{tmp_id}', label=f'[{node.ranges[parent_k,0]:.2f},{node.ranges[parent_k,1]:.2f})')
+                        try:
+                            label_string += f'\\l{key}:{np.array2string(value,precision=2,max_line_width=1)}'
+                        except:
+                            label_string += f'\\l{key}:{value}'
+                label_string += '}\\l'
             else:
-                tree_graph.edge(f'{parent_id}', f'{tmp_id}', label=f'{sibling_num}')
-        elif map_tree:
-            tree_graph.edge(f'{tmp_id}', f'{tmp_id}', label=f'approximate\\lmodel tree\\lposterior\\l{approx_posterior:.2f}\\l',color='invis',fontname='helvetica')
-        else:
-            tree_graph.edge(f'{tmp_id}', f'{tmp_id}', label=f'approximate\\lmeta-tree\\lposterior\\l{approx_posterior:.2f}\\l',color='invis',fontname='helvetica')
-        
-        if not node.leaf:
-            for i in range(self.c_num_children_vec[node.k]):
-                node_id = self._visualize_model_recursion(tree_graph,node.children[i],node_id+1,tmp_id,node.k,i,tmp_p_s*node.h_g,approx_posterior,map_tree,h_params)
-        
-        return node_id
-
-    def _visualize_model_recursion_none(self,tree_graph,depth,k_candidates,ranges,node_id,parent_id,parent_k,sibling_num,p_s,h_params):
-        tmp_id = node_id
-        tmp_p_s = p_s
-        
-        # add node information
-        if depth == self.c_max_depth or not k_candidates:
-            label_string = 'k=None\\l'
-        else:
-            k = k_candidates[self.hn_k_weight_vec[k_candidates].argmax()]
-            label_string = f'k={k}\\l'
-            if k < self.c_dim_continuous:
-                thresholds = np.linspace(ranges[k,0],ranges[k,1],self.c_num_children_vec[k]+1)
-                label_string += f'thresholds=\\l{np.array2string(thresholds[1:-1],precision=2)}\\l'
+                label_string += 'sub_model=\\lNone\\l'
+
+            tree_graph.node(name=f'{node_id}',label=label_string,fillcolor=f'{rgb2hex(_CMAP(p_s))}')
+            if p_s > 0.65:
+                tree_graph.node(name=f'{node_id}',fontcolor='white')
+
+            # add edge information
+            if parent_id is not None:
+                if parent_k < c_dim_continuous:
+                    if node.ranges[parent_k,0] <= c_ranges[parent_k,0] + 1.0E-8:
+                        tree_graph.edge(f'{parent_id}', f'{node_id}', label=f'[*,{node.ranges[parent_k,1]:.2f})')
+                    elif node.ranges[parent_k,1] >= c_ranges[parent_k,1] - 1.0E-8:
+                        tree_graph.edge(f'{parent_id}', f'{node_id}', label=f'[{node.ranges[parent_k,0]:.2f},*)')
+                    else:
+                        tree_graph.edge(f'{parent_id}', f'{node_id}', label=f'[{node.ranges[parent_k,0]:.2f},{node.ranges[parent_k,1]:.2f})')
+                else:
+                    tree_graph.edge(f'{parent_id}', f'{node_id}', label=f'{sibling_num}')
+            elif approx_posterior is None:
+                pass
+            elif map_tree:
+                tree_graph.edge(f'{node_id}', f'{node_id}', label=f'approximate\\lmodel tree\\lposterior\\l{approx_posterior:.2f}\\l',color='invis',fontname='helvetica')
             else:
-                thresholds = None
-            child_k_candidates = k_candidates.copy()
-            if self.c_num_assignment_vec[k] > 0:
-                child_k_candidates.remove(k)
-        label_string += f'hn_g={self.hn_g:.2f}\\lp_s={tmp_p_s:.2f}\\l'
+                tree_graph.edge(f'{node_id}', f'{node_id}', label=f'approximate\\lmeta-tree\\lposterior\\l{approx_posterior:.2f}\\l',color='invis',fontname='helvetica')
 
-        sub_model = self.SubModel.LearnModel(
-            **self.sub_constants,
-            **self.sub_h0_params).set_hn_params(**self.sub_hn_params)
-        if h_params:
-            label_string += 'sub_hn_params={'
-            sub_params = sub_model.get_hn_params()
-        else:
-            label_string += 'sub_params={'
-            try:
-                sub_params = sub_model.estimate_params(loss='0-1',dict_out=True)
-            except:
-                sub_params = sub_model.estimate_params(dict_out=True)
-
-        for key,value in sub_params.items():
-            try:
-                label_string += f'\\l{key}:{value:.2f}'
-            except:
-                try:
-                    label_string += f'\\l{key}:{np.array2string(value,precision=2,max_line_width=1)}'
-                except:
-                    label_string += f'\\l{key}:{value}'
-        label_string += '}\\l'
+            if not node.leaf:
+                for i in reversed(range(c_num_children_vec[node.k])):
+                    stack.append((node.children[i],node_id,node.k,i,p_s*node.h_g))
 
-        tree_graph.node(name=f'{tmp_id}',label=label_string,fillcolor=f'{rgb2hex(_CMAP(tmp_p_s))}')
-        if tmp_p_s > 0.65:
-            tree_graph.node(name=f'{tmp_id}',fontcolor='white')
-        
-        # add edge information
-        if parent_id is not None:
-            if parent_k < self.c_dim_continuous:
-                if ranges[parent_k,0] <= self.c_ranges[parent_k,0] + 1.0E-8:
-                    tree_graph.edge(f'{parent_id}', f'{tmp_id}', label=f'[*,{ranges[parent_k,1]:.2f})')
-                elif ranges[parent_k,1] >= self.c_ranges[parent_k,1] - 1.0E-8:
-                    tree_graph.edge(f'{parent_id}', f'{tmp_id}', label=f'[{ranges[parent_k,0]:.2f},*)')
-                else:
-                    tree_graph.edge(f'{parent_id}', f'{tmp_id}', label=f'[{ranges[parent_k,0]:.2f},{ranges[parent_k,1]:.2f})')
-            else:
-                tree_graph.edge(f'{parent_id}', f'{tmp_id}', label=f'{sibling_num}')
-        
-        if depth < self.c_max_depth and k_candidates:
-            for i in range(self.c_num_children_vec[k]):
-                child_ranges = np.array(ranges)
-                if thresholds is not None:
-                    child_ranges[k,0] = thresholds[i]
-                    child_ranges[k,1] = thresholds[i+1]
-                node_id = self._visualize_model_recursion_none(tree_graph,depth+1,child_k_candidates,child_ranges,node_id+1,tmp_id,k,i,tmp_p_s*self.hn_g,h_params)
-        
         return node_id
 
+    def _make_default_metatree(self):
+        # The meta-tree drawn when hn_metatree_list is empty: every node splits on the feature 
+        # with the largest hn_k_weight_vec, and has hn_g.
+        c_max_depth = self.c_max_depth
+        c_dim_continuous = self.c_dim_continuous
+        c_num_children_vec = self.c_num_children_vec
+        c_num_assignment_vec = self.c_num_assignment_vec
+        hn_k_weight_vec = self.hn_k_weight_vec
+        hn_g = self.hn_g
+        root = _Node(0,self._root_k_candidates,hn_g,ranges=self.c_ranges)
+        stack = [root]
+        while stack:
+            node = stack.pop()
+            if node.depth == c_max_depth or not node.k_candidates:
+                node.leaf = True
+                continue
+            node.k = node.k_candidates[hn_k_weight_vec[node.k_candidates].argmax()]
+            num_children = c_num_children_vec[node.k]
+            if node.k < c_dim_continuous:
+                node.thresholds = (node.ranges[node.k,0]
+                                   + (node.ranges[node.k,1]-node.ranges[node.k,0]) * self._unit_grid[num_children])
+            child_k_candidates = _child_k_candidates(node,c_num_assignment_vec)
+            node.children = [None for i in range(num_children)]
+            for i in range(num_children):
+                node.children[i] = _Node(node.depth+1,child_k_candidates,hn_g,ranges=node.ranges.copy())
+                if node.thresholds is not None:
+                    node.children[i].ranges[node.k,0] = node.thresholds[i]
+                    node.children[i].ranges[node.k,1] = node.thresholds[i+1]
+            stack.extend(node.children)
+        return root
+
     def visualize_posterior(self,filename=None,format=None,num_metatrees=3,h_params=False):
         """Visualize the posterior distribution for the parameter.
         
@@ -3167,30 +3294,33 @@ class LearnModel(base.Posterior,base.PredictiveMixin):
                     "self.hn_metatree_list is empty. "
                     +"Therefore, one of the most likely meta-tree will be visualized.",
                     ResultWarning)
-                self._visualize_model_recursion_none(
+                sub_model = self.SubModel.LearnModel(
+                    **self.sub_constants,
+                    **self.sub_h0_params).set_hn_params(**self.sub_hn_params)
+                if h_params:
+                    sub_params = sub_model.get_hn_params()
+                else:
+                    try:
+                        sub_params = sub_model.estimate_params(loss='0-1',dict_out=True)
+                    except:
+                        sub_params = sub_model.estimate_params(dict_out=True)
+                self._visualize_metatree(
                     tree_graph,
+                    self._make_default_metatree(),
                     0,
-                    self._root_k_candidates,
-                    self.c_ranges,
-                    0,
-                    None,
-                    None,
                     None,
-                    1.0,
+                    False,
                     h_params,
+                    sub_params,
                     )
             else:
                 node_id = -1
                 indices = np.argsort(self.hn_metatree_prob_vec)[::-1]
                 for i in range(min(num_metatrees,len(self.hn_metatree_list))):
-                    node_id = self._visualize_model_recursion(
+                    node_id = self._visualize_metatree(
                         tree_graph,
                         self.hn_metatree_list[indices[i]],
                         node_id+1,
-                        None,
-                        None,
-                        None,
-                        1.0,
                         self.hn_metatree_prob_vec[indices[i]],
                         False,
                         h_params,
@@ -3214,49 +3344,81 @@ class LearnModel(base.Posterior,base.PredictiveMixin):
         """
         return None
     
-    def _calc_pred_dist_recursion_batch(self,node:_Node,x_continuous,x_categorical):
-        node.sub_model.calc_pred_dist()
-        if not node.leaf:  # inner node
-            node._p_indices = np.empty((x_continuous.shape[0],self.c_num_children_vec[node.k]),dtype=bool)
-            for i in range(self.c_num_children_vec[node.k]):
-                if node.k < self.c_dim_continuous:
-                    if i == 0:
-                        node._p_indices[:,i] = x_continuous[:,node.k] < node.thresholds[i+1]
-                    elif i == self.c_num_children_vec[node.k]-1:
-                        node._p_indices[:,i] = node.thresholds[i] <= x_continuous[:,node.k]
-                    else:
-                        node._p_indices[:,i] = (node.thresholds[i] <= x_continuous[:,node.k]) & (x_continuous[:,node.k] < node.thresholds[i+1])
-                else:
-                    node._p_indices[:,i] = x_categorical[:,node.k-self.c_dim_continuous] == i
-                    
-                if np.any(node._p_indices[:,i]):
-                    self._calc_pred_dist_recursion_batch(
-                        node.children[i],
-                        x_continuous[node._p_indices[:,i]],
-                        x_categorical[node._p_indices[:,i]],
-                    )
+    def _check_hn_metatree_list(self):
+        if not self.hn_metatree_list:
+            raise(ParameterFormatError(
+                "self.hn_metatree_list is empty. "
+                +"Call update_posterior or set_hn_params before this function."
+            ))
 
-    def _calc_pred_dist_recursion_lr_batch(self,node:_Node,x_continuous,x_categorical):
-        node.sub_model._calc_pred_dist(x_continuous)
-        if not node.leaf:  # inner node
-            node._p_indices = np.empty((x_continuous.shape[0],self.c_num_children_vec[node.k]),dtype=bool)
-            for i in range(self.c_num_children_vec[node.k]):
-                if node.k < self.c_dim_continuous:
-                    if i == 0:
-                        node._p_indices[:,i] = x_continuous[:,node.k] < node.thresholds[i+1]
-                    elif i == self.c_num_children_vec[node.k]-1:
-                        node._p_indices[:,i] = node.thresholds[i] <= x_continuous[:,node.k]
-                    else:
-                        node._p_indices[:,i] = (node.thresholds[i] <= x_continuous[:,node.k]) & (x_continuous[:,node.k] < node.thresholds[i+1])
-                else:
-                    node._p_indices[:,i] = x_categorical[:,node.k-self.c_dim_continuous] == i
-                    
-                if np.any(node._p_indices[:,i]):
-                    self._calc_pred_dist_recursion_lr_batch(
-                        node.children[i],
-                        x_continuous[node._p_indices[:,i]],
-                        x_categorical[node._p_indices[:,i]],
-                    )
+    def _flatten_metatree(self,root:_Node,x_continuous,x_categorical):
+        # Returns the nodes reached by the samples in level order, the rows of the samples reaching each node, 
+        # and path_mat whose [j,d] element is the index of the node at depth d on the path of the j-th sample 
+        # (-1 below its leaf).
+        # The samples are routed one level at a time. At each level, rows holds the rows of all the nodes 
+        # of the level in order, and the child of each row is computed at once from padded threshold tables.
+        c_dim_continuous = self.c_dim_continuous
+        c_num_children_vec = self.c_num_children_vec
+        node_list = [root]
+        rows_list = [np.arange(x_continuous.shape[0])]
+        path_mat = np.full((x_continuous.shape[0],self.c_max_depth+1),-1,dtype=int)
+        level_start = 0
+        rows = rows_list[0]
+        while level_start < len(node_list):
+            level_node_list = node_list[level_start:]
+            num_nodes = len(level_node_list)
+            row_node_vec = np.repeat(
+                np.arange(num_nodes),
+                [tmp_rows.shape[0] for tmp_rows in rows_list[level_start:]])
+            path_mat[rows,level_node_list[0].depth] = level_start + row_node_vec
+
+            # tables of the inner nodes of this level. The thresholds are padded with nan, which no value exceeds.
+            k_vec = np.zeros(num_nodes,dtype=int)
+            num_children_vec = np.zeros(num_nodes,dtype=int)
+            for i,node in enumerate(level_node_list):
+                if not node.leaf:
+                    k_vec[i] = node.k
+                    num_children_vec[i] = c_num_children_vec[node.k]
+            if not np.any(num_children_vec):
+                break
+            thresholds_mat = np.full((num_nodes,num_children_vec.max()-1),np.nan)
+            for i,node in enumerate(level_node_list):
+                if num_children_vec[i] > 0 and node.k < c_dim_continuous:
+                    thresholds_mat[i,:num_children_vec[i]-1] = node.thresholds[1:num_children_vec[i]]
+
+            # route the rows of the inner nodes
+            inner_rows_mask = num_children_vec[row_node_vec] > 0
+            inner_rows = rows[inner_rows_mask]
+            inner_row_node_vec = row_node_vec[inner_rows_mask]
+            inner_row_k_vec = k_vec[inner_row_node_vec]
+            bucket = np.empty(inner_rows.shape[0],dtype=int)
+            continuous_mask = inner_row_k_vec < c_dim_continuous
+            if np.any(continuous_mask):
+                bucket[continuous_mask] = (
+                    x_continuous[inner_rows[continuous_mask],inner_row_k_vec[continuous_mask],np.newaxis]
+                    >= thresholds_mat[inner_row_node_vec[continuous_mask]]
+                    ).sum(axis=1)
+            if not np.all(continuous_mask):
+                categorical_mask = ~continuous_mask
+                bucket[categorical_mask] = x_categorical[inner_rows[categorical_mask],inner_row_k_vec[categorical_mask]-c_dim_continuous]
+
+            # group the rows by child, keeping the order of the rows within each child
+            child_offsets = np.zeros(num_nodes+1,dtype=int)
+            np.cumsum(num_children_vec,out=child_offsets[1:])
+            order,bounds = _partition(child_offsets[inner_row_node_vec]+bucket,child_offsets[-1])
+            rows = inner_rows[order]
+            bounds = bounds.tolist()
+
+            level_start = len(node_list)
+            for i,node in enumerate(level_node_list):
+                if num_children_vec[i] == 0:
+                    continue
+                splits = bounds[child_offsets[i]:child_offsets[i+1]+1]
+                for j in range(num_children_vec[i]):
+                    if splits[j] < splits[j+1]:
+                        node_list.append(node.children[j])
+                        rows_list.append(rows[splits[j]:splits[j+1]])
+        return node_list,rows_list,path_mat
 
     def calc_pred_dist(self,x_continuous=None,x_categorical=None):
         """Calculate the parameters of the predictive distribution.
@@ -3275,39 +3437,75 @@ class LearnModel(base.Posterior,base.PredictiveMixin):
         self._p_n = x_continuous.shape[0]
 
         if self.SubModel is linearregression:
-            for root in self.hn_metatree_list:
-                self._calc_pred_dist_recursion_lr_batch(root,x_continuous,x_categorical)
+            sub_call = lambda node,rows: node.sub_model._calc_pred_dist(x_continuous[rows])
         else:
-            for root in self.hn_metatree_list:
-                self._calc_pred_dist_recursion_batch(root,x_continuous,x_categorical)
+            sub_call = lambda node,rows: node.sub_model.calc_pred_dist()
+        self._p_flat_metatree_list = []
+        self._p_metatree_indices = []
+        for i,root in enumerate(self.hn_metatree_list):
+            if self.hn_metatree_prob_vec[i] <= _PROB_EPS:
+                continue
+            node_list,rows_list,path_mat = self._flatten_metatree(root,x_continuous,x_categorical)
+            for node,rows in zip(node_list,rows_list):
+                sub_call(node,rows)
+            self._p_flat_metatree_list.append((node_list,rows_list,path_mat,{}))
+            self._p_metatree_indices.append(i)
         return self
 
-    def _make_prediction_recursion_squared_batch(self,node:_Node):
-        if node.leaf:  # leaf node
-            return node.sub_model.make_prediction(loss='squared')
-        else:  # inner node
-            tmp_pred_values = np.empty(node._p_indices.shape[0])
-            tmp_pred_values[:] = node.sub_model.make_prediction(loss='squared')
-            for i in range(self.c_num_children_vec[node.k]):
-                if np.any(node._p_indices[:,i]):
-                    tmp_pred_values[node._p_indices[:,i]] = (
-                        (1-node.h_g) * tmp_pred_values[node._p_indices[:,i]]
-                        + node.h_g * self._make_prediction_recursion_squared_batch(node.children[i])
-                    )
-            return tmp_pred_values
-
-    def _make_prediction_recursion_kl_batch(self,node:_Node):
-        if node.leaf:  # leaf node
-            return node.sub_model.make_prediction(loss='KL')
-        else:  # inner node
-            tmp_pred_values = np.tile(node.sub_model.make_prediction(loss='KL'),(node._p_indices.shape[0],1))
-            for i in range(self.c_num_children_vec[node.k]):
-                if np.any(node._p_indices[:,i]):
-                    tmp_pred_values[node._p_indices[:,i]] = (
-                        (1-node.h_g) * tmp_pred_values[node._p_indices[:,i]]
-                        + node.h_g * self._make_prediction_recursion_kl_batch(node.children[i])
-                    )
-            return tmp_pred_values
+    # The weights and the outputs of the sub models below do not change until the next calc_pred_dist, 
+    # so they are cached in the last element of each tuple in self._p_flat_metatree_list.
+    def _calc_flat_weight_vec(self,node_list,rows_list,path_mat,cache):
+        # The j-th element is the weight of the prediction of node_list[j], i.e., 
+        # the product of h_g along the path from the root and 1-h_g of the node itself.
+        # It is the same for all the samples reaching the node.
+        # The last element is 0 for the index -1 below the leaves.
+        if 'weight' not in cache:
+            weight_vec = np.zeros(len(node_list)+1)
+            prefix_vec = np.ones(len(node_list))
+            for j,node in enumerate(node_list):
+                if node.depth > 0:
+                    parent = path_mat[rows_list[j][0],node.depth-1]
+                    prefix_vec[j] = prefix_vec[parent] * node_list[parent].h_g
+                weight_vec[j] = prefix_vec[j] if node.leaf else prefix_vec[j] * (1-node.h_g)
+            cache['weight'] = weight_vec
+        return cache['weight']
+
+    def _calc_flat_node_values(self,node_list,cache,key):
+        # key is 'squared', 'KL', or 'var'.
+        # For linearregression, the list of the values for the rows of each node is returned.
+        # Otherwise, the values are stacked with trailing zeros for the index -1 below the leaves.
+        if key not in cache:
+            if key == 'var':
+                values = [node.sub_model.calc_pred_var() for node in node_list]
+            else:
+                values = [node.sub_model.make_prediction(loss=key) for node in node_list]
+            if self.SubModel is not linearregression:
+                values = np.array(values)
+                values = np.concatenate((values,np.zeros((1,)+values.shape[1:])))
+            cache[key] = values
+        return cache[key]
+
+    def _make_prediction_flat_squared(self,node_list,rows_list,path_mat,cache,metatree_prob,out):
+        # metatree_prob times the predictions are added to out, whose shape is (sample_size,).
+        weight_vec = metatree_prob * self._calc_flat_weight_vec(node_list,rows_list,path_mat,cache)
+        means_vec = self._calc_flat_node_values(node_list,cache,'squared')
+        if self.SubModel is linearregression:
+            for j,rows in enumerate(rows_list):
+                out[rows] += weight_vec[j] * means_vec[j]
+        else:
+            weight_vec *= means_vec
+            for d in range(path_mat.shape[1]):
+                out += weight_vec[path_mat[:,d]]
+        return out
+
+    def _make_prediction_flat_kl(self,node_list,rows_list,path_mat,cache,metatree_prob,out):
+        # Same as _make_prediction_flat_squared, but each node gives a probability vector.
+        # The shape of out is (sample_size,degree).
+        weight_vec = metatree_prob * self._calc_flat_weight_vec(node_list,rows_list,path_mat,cache)
+        pred_vec = weight_vec[:,np.newaxis] * self._calc_flat_node_values(node_list,cache,'KL')
+        for d in range(path_mat.shape[1]):
+            out += pred_vec[path_mat[:,d]]
+        return out
 
     def make_prediction(self,loss=None):
         """Predict a new data point under the given criterion.
@@ -3338,32 +3536,34 @@ class LearnModel(base.Posterior,base.PredictiveMixin):
             else: # the case where self.SubModel is in CLF_MODELS
                 loss = "0-1"
         
+        self._check_hn_metatree_list()
+        metatree_prob_vec = self.hn_metatree_prob_vec
         if loss == "squared":
             if self.SubModel in REG_MODELS:
-                tmp_pred_vec = np.empty([len(self.hn_metatree_list),self._p_n])
-                for i,metatree in enumerate(self.hn_metatree_list):
-                    tmp_pred_vec[i] = self._make_prediction_recursion_squared_batch(metatree)
-                return self.hn_metatree_prob_vec @ tmp_pred_vec
+                pred_values = np.zeros(self._p_n)
+                for i,flat_metatree in zip(self._p_metatree_indices,self._p_flat_metatree_list):
+                    self._make_prediction_flat_squared(*flat_metatree,metatree_prob_vec[i],pred_values)
+                return pred_values
             else:
                 raise(CriteriaError("Unsupported loss function! \"squared\" is supported "
                                     +"only when self.SubModel is normal, linearregression, exponential, or poisson."))
         elif loss == "0-1":
             if self.SubModel in CLF_MODELS:
                 degree = 2 if self.SubModel is bernoulli else self.sub_constants['c_degree']
-                tmp_pred_dist_vec = np.empty([self._p_n,len(self.hn_metatree_list),degree])
-                for i,metatree in enumerate(self.hn_metatree_list):
-                    tmp_pred_dist_vec[:,i] = self._make_prediction_recursion_kl_batch(metatree)
-                return np.argmax(self.hn_metatree_prob_vec @ tmp_pred_dist_vec,axis=1)
+                pred_dist_vec = np.zeros([self._p_n,degree])
+                for i,flat_metatree in zip(self._p_metatree_indices,self._p_flat_metatree_list):
+                    self._make_prediction_flat_kl(*flat_metatree,metatree_prob_vec[i],pred_dist_vec)
+                return np.argmax(pred_dist_vec,axis=1)
             else:
                 raise(CriteriaError("Unsupported loss function! \"0-1\" is supported "
                                     +"only when self.SubModel is bernoulli or categorical."))
         elif loss == "KL":
             if self.SubModel in CLF_MODELS:
                 degree = 2 if self.SubModel is bernoulli else self.sub_constants['c_degree']
-                tmp_pred_dist_vec = np.empty([self._p_n,len(self.hn_metatree_list),degree])
-                for i,metatree in enumerate(self.hn_metatree_list):
-                    tmp_pred_dist_vec[:,i] = self._make_prediction_recursion_kl_batch(metatree)
-                return self.hn_metatree_prob_vec @ tmp_pred_dist_vec
+                pred_dist_vec = np.zeros([self._p_n,degree])
+                for i,flat_metatree in zip(self._p_metatree_indices,self._p_flat_metatree_list):
+                    self._make_prediction_flat_kl(*flat_metatree,metatree_prob_vec[i],pred_dist_vec)
+                return pred_dist_vec
             else:
                 raise(CriteriaError("Unsupported loss function! \"KL\" is supported "
                                     +"only when self.SubModel is bernoulli or categorical."))
@@ -3406,30 +3606,36 @@ class LearnModel(base.Posterior,base.PredictiveMixin):
         self.update_posterior(x_continuous,x_categorical,y,alg_type='given_MT')
         return prediction
 
-    def _calc_pred_var_recursion_batch(self,node:_Node):
-        if node.leaf:  # leaf node
-            return (node.sub_model.make_prediction(loss='squared'),
-                    node.sub_model.calc_pred_var())
-        else:  # inner node
-            tmp_means_child = np.empty(node._p_indices.shape[0])
-            tmp_vars_child = np.empty(node._p_indices.shape[0])
-            for i in range(self.c_num_children_vec[node.k]):
-                if np.any(node._p_indices[:,i]):
-                    (tmp_means_child[node._p_indices[:,i]],
-                     tmp_vars_child[node._p_indices[:,i]]) = (
-                        self._calc_pred_var_recursion_batch(node.children[i])
-                    )
-
-            tmp_means = np.empty(node._p_indices.shape[0])
-            tmp_vars = np.empty(node._p_indices.shape[0])
-            tmp_means[:] = node.sub_model.make_prediction(loss='squared')
-            tmp_vars[:] = node.sub_model.calc_pred_var()
-
-            mix_means = (1-node.h_g) * tmp_means + node.h_g * tmp_means_child
-            mix_vars = ((1-node.h_g) * ((mix_means-tmp_means)*(mix_means-tmp_means)+tmp_vars)
-                       + node.h_g * ((mix_means-tmp_means_child)*(mix_means-tmp_means_child)+tmp_vars_child))
-
-            return mix_means,mix_vars
+    def _get_scratch(self,name,size):
+        # Returns a work array of the given size that is reused across calls. 
+        # Its values are undefined, and it must not be returned to the user.
+        if name not in self._scratch or self._scratch[name].shape[0] < size:
+            self._scratch[name] = np.empty(size)
+        return self._scratch[name][:size]
+
+    def _calc_pred_var_flat(self,node_list,rows_list,path_mat,cache,metatree_prob,mix_means,out):
+        # The predictive distribution is a mixture of those of the nodes, so its variance is 
+        # the weighted sum of (mean-mix_means)**2+var of the nodes, where mix_means is the mean of the mixture.
+        # metatree_prob times the weighted sum is added to out.
+        weight_vec = metatree_prob * self._calc_flat_weight_vec(node_list,rows_list,path_mat,cache)
+        means_vec = self._calc_flat_node_values(node_list,cache,'squared')
+        vars_vec = self._calc_flat_node_values(node_list,cache,'var')
+        if self.SubModel is linearregression:
+            for j,rows in enumerate(rows_list):
+                out[rows] += weight_vec[j] * ((means_vec[j]-mix_means[rows])**2 + vars_vec[j])
+        else:
+            # the gathered values are combined in place in two buffers.
+            # np.take buffers out unless mode is 'wrap' or 'clip', and 'wrap' still maps -1 to the trailing zero.
+            tmp_values = self._get_scratch('values',path_mat.shape[0])
+            tmp_vars = self._get_scratch('vars',path_mat.shape[0])
+            for d in range(path_mat.shape[1]):
+                np.take(means_vec,path_mat[:,d],out=tmp_values,mode='wrap')
+                tmp_values -= mix_means
+                tmp_values *= tmp_values
+                tmp_values += np.take(vars_vec,path_mat[:,d],out=tmp_vars,mode='wrap')
+                tmp_values *= np.take(weight_vec,path_mat[:,d],out=tmp_vars,mode='wrap')
+                out += tmp_values
+        return out
 
     def calc_pred_var(self):
         """Calculate the variance of the predictive distribution.
@@ -3442,26 +3648,31 @@ class LearnModel(base.Posterior,base.PredictiveMixin):
         """
         if self.SubModel not in {normal,linearregression}:
             raise(ParameterFormatError("SubModel must be normal or linearregression."))
-        tmp_means = np.empty([len(self.hn_metatree_list),self._p_n])
-        tmp_vars = np.empty([len(self.hn_metatree_list),self._p_n])
-        for i,metatree in enumerate(self.hn_metatree_list):
-            tmp_means[i],tmp_vars[i] = self._calc_pred_var_recursion_batch(metatree)
-        mix_means = self.hn_metatree_prob_vec @ tmp_means
-        return self.hn_metatree_prob_vec @ ((tmp_means-mix_means)*(tmp_means-mix_means)+tmp_vars)
-
-    def _calc_feature_importances_recursion(self,node:_Node):
-        if node.leaf:
-            return 0
-        else:
-            tmp_feature_importances = np.zeros(self.c_dim_features)
-            for i in range(self.c_num_children_vec[node.k]):
-                tmp_feature_importances += self._calc_feature_importances_recursion(node.children[i])
-            
-            for i in range(self.c_num_children_vec[node.k]):
-                tmp_feature_importances[node.k] += node.children[i].log_marginal_likelihood
-            tmp_feature_importances[node.k] -= node.log_marginal_likelihood
-            
-            return node.h_g * tmp_feature_importances
+        self._check_hn_metatree_list()
+        metatree_prob_vec = self.hn_metatree_prob_vec
+        mix_means = np.zeros(self._p_n)
+        for i,flat_metatree in zip(self._p_metatree_indices,self._p_flat_metatree_list):
+            self._make_prediction_flat_squared(*flat_metatree,metatree_prob_vec[i],mix_means)
+        mix_vars = np.zeros(self._p_n)
+        for i,flat_metatree in zip(self._p_metatree_indices,self._p_flat_metatree_list):
+            self._calc_pred_var_flat(*flat_metatree,metatree_prob_vec[i],mix_means,mix_vars)
+        return mix_vars
+
+    def _calc_feature_importances_metatree(self,root:_Node,metatree_prob,k_list,contrib_list):
+        # Each inner node adds (the sum of log_marginal_likelihood of its children - its own) 
+        # to the importance of node.k, weighted by metatree_prob and the product of h_g from the root to itself.
+        # The features and the contributions are appended to k_list and contrib_list.
+        stack = [(root,metatree_prob)]
+        while stack:
+            node,weight = stack.pop()
+            if node.leaf:
+                continue
+            weight *= node.h_g
+            k_list.append(node.k)
+            contrib_list.append(
+                weight * (sum(child.log_marginal_likelihood for child in node.children)
+                          - node.log_marginal_likelihood))
+            stack.extend((child,weight) for child in node.children)
 
     def calc_feature_importances(self):
         """Calculate the feature importances
@@ -3471,23 +3682,25 @@ class LearnModel(base.Posterior,base.PredictiveMixin):
         feature_importances : numpy.ndarray
             The feature importances.
         """
+        self._check_hn_metatree_list()
         feature_importances = np.zeros(self.c_dim_features)
-        for i,metatree in enumerate(self.hn_metatree_list):
-            feature_importances += self.hn_metatree_prob_vec[i] * self._calc_feature_importances_recursion(metatree)
+        k_list = []
+        contrib_list = []
+        for metatree,metatree_prob in zip(self.hn_metatree_list,self.hn_metatree_prob_vec):
+            if metatree_prob > _PROB_EPS:
+                self._calc_feature_importances_metatree(metatree,metatree_prob,k_list,contrib_list)
+        feature_importances += np.bincount(np.array(k_list,dtype=int),weights=contrib_list,minlength=self.c_dim_features)
         return feature_importances
 
-    def _calc_pred_density_recursion_batch(self,node:_Node,y):
-        if node.leaf:  # leaf node
-            return node.sub_model._calc_pred_density(y)
-        else:  # inner node
-            tmp_pred_densities = node.sub_model._calc_pred_density(y)
-            for i in range(self.c_num_children_vec[node.k]):
-                if np.any(node._p_indices[:,i]):
-                    tmp_pred_densities[...,node._p_indices[:,i]] = (
-                        (1-node.h_g) * tmp_pred_densities[...,node._p_indices[:,i]]
-                        + node.h_g * self._calc_pred_density_recursion_batch(node.children[i],y[...,node._p_indices[:,i]])
-                    )
-            return tmp_pred_densities
+    def _calc_pred_density_flat(self,node_list,rows_list,path_mat,cache,metatree_prob,y,out):
+        # metatree_prob times the weighted sum of the densities of the nodes is added to out.
+        weight_vec = metatree_prob * self._calc_flat_weight_vec(node_list,rows_list,path_mat,cache)
+        for j,(node,rows) in enumerate(zip(node_list,rows_list)):
+            if rows.shape[0] == y.shape[-1]: # all the samples reach the node, e.g., the root or _p_n == 1
+                out += weight_vec[j] * node.sub_model._calc_pred_density(y)
+            else:
+                out[...,rows] += weight_vec[j] * node.sub_model._calc_pred_density(y[...,rows])
+        return out
 
     def calc_pred_density(self,y):
         """Calculate the values of the probability density function of the predictive distribution.
@@ -3504,12 +3717,13 @@ class LearnModel(base.Posterior,base.PredictiveMixin):
         p_y : numpy.ndarray
             The values of the probability density function of the predictive distribution.
         """
+        self._check_hn_metatree_list()
         if self.SubModel is linearregression:
             y = self.SubModel.LearnModel(**self.sub_constants)._check_sample_y(y)
         else:
             y = self.SubModel.LearnModel(**self.sub_constants)._check_sample(y)
         try:
-            y = y + np.zeros(self._p_n,dtype=y.dtype)
+            y = np.broadcast_to(y,np.broadcast_shapes(y.shape,(self._p_n,))) # a read-only view
         except:
             raise(DataFormatError(
                 f"y must have a size that is broadcastable to ({self._p_n},). "
@@ -3520,9 +3734,10 @@ class LearnModel(base.Posterior,base.PredictiveMixin):
         if self._p_n == 1 and y.shape[-1] != 1:
             flag=True
             y = y[...,np.newaxis]
-        tmp = 0.0
-        for i,metatree in enumerate(self.hn_metatree_list):
-            tmp += self.hn_metatree_prob_vec[i] * self._calc_pred_density_recursion_batch(metatree,y)
+        metatree_prob_vec = self.hn_metatree_prob_vec
+        tmp = np.zeros(y.shape)
+        for i,flat_metatree in zip(self._p_metatree_indices,self._p_flat_metatree_list):
+            self._calc_pred_density_flat(*flat_metatree,metatree_prob_vec[i],y,tmp)
         if flag:
             return tmp[...,0]
         else:
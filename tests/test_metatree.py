@@ -1,6 +1,7 @@
 import pytest
 import os
 import sys
+import copy
 
 # Add the parent directory to sys.path
 # NOTE: This is a workaround for the import error when running the test file directly.
@@ -10,6 +11,7 @@ sys.path.append(parent_path)
 from bayesml import metatree
 from bayesml import normal, linearregression, poisson, exponential # REG models
 from bayesml import bernoulli, categorical # CLF models
+from bayesml._exceptions import ParameterFormatError
 
 import numpy as np
 
@@ -415,5 +417,389 @@ def test_metatree_exponential_batch_pred(metatree_sample_data):
     # check if the prediction densities are close to the desired values
     assert np.all(np.isclose(pred_densities, desireble_pred_densities)), f"Prediction densities are incorrect: {pred_densities} != {desireble_pred_densities}"
 
+def _metatree_snapshot(root):
+    # depth, k, thresholds, h_g and the sub model parameters of the nodes in preorder
+    snapshot = []
+    stack = [root]
+    while stack:
+        node = stack.pop()
+        snapshot.append((
+            node.depth,
+            node.leaf,
+            None if node.leaf else node.k,
+            None if node.leaf or node.thresholds is None else np.array(node.thresholds),
+            node.h_g,
+            {key:np.array(value) for key,value in node.sub_model.get_hn_params().items()},
+        ))
+        if not node.leaf:
+            stack.extend(reversed(node.children))
+    return snapshot
+
+def test_metatree_set_hn_params_same_list(metatree_sample_data):
+    x_continuous = metatree_sample_data['x_continuous']
+    x_categorical = metatree_sample_data['x_categorical']
+    y_continuous = metatree_sample_data['y_continuous']
+
+    # initialise the model
+    model = metatree.LearnModel(
+        c_dim_continuous=3,
+        c_dim_categorical=2,
+        SubModel=normal,
+    )
+    # update the posterior distribution
+    model.update_posterior(
+        x_continuous=x_continuous,
+        x_categorical=x_categorical,
+        y=y_continuous,
+        random_state=123,
+    )
+    roots = list(model.hn_metatree_list)
+    snapshots = [_metatree_snapshot(root) for root in roots]
+    prob_vec = model.hn_metatree_prob_vec.copy()
+
+    # set the trees that the model already has
+    model.set_hn_params(
+        hn_metatree_list=model.hn_metatree_list,
+        hn_metatree_prob_vec=model.hn_metatree_prob_vec,
+    )
+    # the trees must be left as they are
+    assert np.all(model.hn_metatree_prob_vec == prob_vec)
+    assert len(model.hn_metatree_list) == len(roots)
+    for root,original_root,snapshot in zip(model.hn_metatree_list,roots,snapshots):
+        assert root is original_root
+        new_snapshot = _metatree_snapshot(root)
+        assert len(new_snapshot) == len(snapshot)
+        for new_node,node in zip(new_snapshot,snapshot):
+            assert new_node[:3] == node[:3]
+            assert np.array_equal(new_node[3],node[3])
+            assert new_node[4] == node[4]
+            assert new_node[5].keys() == node[5].keys()
+            for key in node[5]:
+                assert np.array_equal(new_node[5][key],node[5][key])
+
+def _fit_remtmcmc(data,num_chains,**kwargs):
+    model = metatree.LearnModel(
+        c_dim_continuous=3,
+        c_dim_categorical=2,
+        SubModel=normal,
+    )
+    model.update_posterior(
+        x_continuous=data['x_continuous'],
+        x_categorical=data['x_categorical'],
+        y=data['y_continuous'],
+        alg_type='REMTMCMC',
+        burn_in=200,
+        num_metatrees=20,
+        num_chains=num_chains,
+        num_interval=1,
+        seed=SEED,
+        **kwargs,
+    )
+    return model
+
+def test_metatree_remtmcmc_tune_beta(metatree_sample_data):
+    # update the posterior distribution with a tuned geometric ladder
+    model = _fit_remtmcmc(metatree_sample_data,4,beta_min=0.01,tune_beta=True)
+    # the ladder has been tuned in burn-in phase
+    assert not np.allclose(model._beta_vec, np.geomspace(0.01,1.0,4))
+    # the first and the last temperatures are fixed and the ladder stays increasing
+    assert np.isclose(model._beta_vec[0], 0.01)
+    assert model._beta_vec[-1] == 1.0
+    assert np.all(np.diff(model._beta_vec) > 0)
+    assert np.isclose(model.hn_metatree_prob_vec.sum(), 1.0)
+
+    # the same holds for a single tuning step with very uneven acceptance rates
+    model._swap_proposed_vec[:] = 100
+    model._swap_accepted_vec[:] = [100,0,50]
+    model._tune_beta()
+    assert np.isclose(model._beta_vec[0], 0.01)
+    assert model._beta_vec[-1] == 1.0
+    assert np.all(np.diff(model._beta_vec) > 0)
+
+def test_metatree_remtmcmc_single_chain(metatree_sample_data):
+    # a geometric ladder needs at least two chains
+    with pytest.raises(ParameterFormatError):
+        _fit_remtmcmc(metatree_sample_data,1,beta_min=0.01)
+    with pytest.raises(ParameterFormatError):
+        _fit_remtmcmc(metatree_sample_data,1,beta_min=0.01,tune_beta=True)
+
+    # without beta_min, the only chain samples the posterior itself and nothing is tuned
+    model = _fit_remtmcmc(metatree_sample_data,1,tune_beta=True)
+    assert np.all(model._beta_vec == 1.0)
+    assert np.isclose(model.hn_metatree_prob_vec.sum(), 1.0)
+
+def test_metatree_pred_without_posterior(metatree_sample_data):
+    x_continuous = metatree_sample_data['x_continuous']
+    x_categorical = metatree_sample_data['x_categorical']
+
+    # the model has no meta-tree before the posterior is updated
+    model = metatree.LearnModel(
+        c_dim_continuous=3,
+        c_dim_categorical=2,
+        SubModel=normal,
+    )
+    model.calc_pred_dist(x_continuous,x_categorical)
+    with pytest.raises(ParameterFormatError):
+        model.make_prediction(loss='squared')
+    with pytest.raises(ParameterFormatError):
+        model.calc_pred_var()
+    with pytest.raises(ParameterFormatError):
+        model.calc_pred_density(np.arange(2)[:,np.newaxis])
+    with pytest.raises(ParameterFormatError):
+        model.calc_feature_importances()
+
+def _brute_force_pred(model,x_continuous,x_categorical,y):
+    # Computes the mixture over the meta-trees and the nodes on the path of each sample, 
+    # one sample at a time, for comparison with the batch prediction.
+    means = np.zeros(x_continuous.shape[0])
+    second_moments = np.zeros(x_continuous.shape[0])
+    kl_values = []
+    densities = np.zeros(x_continuous.shape[0])
+    for j in range(x_continuous.shape[0]):
+        kl_value = 0.0
+        for root,metatree_prob in zip(model.hn_metatree_list,model.hn_metatree_prob_vec):
+            node = root
+            weight = metatree_prob
+            while True:
+                if model.SubModel is linearregression:
+                    node.sub_model._calc_pred_dist(x_continuous[j:j+1])
+                else:
+                    node.sub_model.calc_pred_dist()
+                node_weight = weight if node.leaf else weight * (1-node.h_g)
+                if model.SubModel is categorical:
+                    kl_value = kl_value + node_weight * node.sub_model.make_prediction(loss='KL')
+                else:
+                    mean = node.sub_model.make_prediction(loss='squared')
+                    var = node.sub_model.calc_pred_var()
+                    means[j] += node_weight * np.squeeze(mean)
+                    second_moments[j] += node_weight * np.squeeze(var + mean**2)
+                densities[j] += node_weight * np.squeeze(node.sub_model._calc_pred_density(y[j:j+1]))
+                if node.leaf:
+                    break
+                weight *= node.h_g
+                if node.k < model.c_dim_continuous:
+                    # thresholds[i] <= x < thresholds[i+1] for the i-th child
+                    i = 0
+                    while i < model.c_num_children_vec[node.k]-1 and node.thresholds[i+1] <= x_continuous[j,node.k]:
+                        i += 1
+                else:
+                    i = x_categorical[j,node.k-model.c_dim_continuous]
+                node = node.children[i]
+        kl_values.append(kl_value)
+    return {
+        'squared': means,
+        'var': second_moments - means**2,
+        'KL': np.array(kl_values),
+        'density': densities,
+    }
+
+def _make_pred_test_data(model,rng,n):
+    # random samples and samples lying exactly on the thresholds of the inner nodes
+    x_continuous = rng.random((n,model.c_dim_continuous))
+    x_categorical = rng.integers(model.c_num_children_vec[model.c_dim_continuous:],size=(n,model.c_dim_categorical))
+    x_continuous_list = [x_continuous]
+    x_categorical_list = [x_categorical]
+    for root in model.hn_metatree_list:
+        stack = [root]
+        while stack:
+            node = stack.pop()
+            if node.leaf:
+                continue
+            if node.k < model.c_dim_continuous:
+                for threshold in node.thresholds[1:model.c_num_children_vec[node.k]]:
+                    x_continuous_list.append(rng.random((1,model.c_dim_continuous)))
+                    x_continuous_list[-1][0,node.k] = threshold
+                    x_categorical_list.append(x_categorical[:1])
+            stack.extend(node.children)
+    return np.concatenate(x_continuous_list), np.concatenate(x_categorical_list)
+
+@pytest.mark.parametrize('SubModel',[normal,linearregression,categorical])
+def test_metatree_batch_pred_brute_force(SubModel):
+    rng = np.random.default_rng(SEED)
+    n = 40
+    x_continuous = rng.random((n,2))
+    x_categorical = rng.choice(3,size=(n,1))
+    if SubModel is categorical:
+        y = (x_continuous[:,0] > 0.5).astype(int) + (x_categorical[:,0] == 2)
+        sub_constants = {'c_degree':3}
+        sub_h0_params = {}
+    else:
+        y = x_continuous[:,0] + (x_categorical[:,0] == 1) + rng.normal(0,0.1,n)
+        sub_constants = {'c_degree':2} if SubModel is linearregression else {}
+        sub_h0_params = {'h0_alpha':1.1} # the predictive variances are finite
+
+    # three children at every inner node, both for the continuous and the categorical features
+    model = metatree.LearnModel(
+        c_dim_continuous=2,
+        c_dim_categorical=1,
+        c_max_depth=3,
+        c_num_children_vec=3,
+        SubModel=SubModel,
+        sub_constants=sub_constants,
+        sub_h0_params=sub_h0_params,
+    )
+    model.update_posterior(
+        x_continuous=x_continuous,
+        x_categorical=x_categorical,
+        y=y,
+        alg_type='MTMCMC',
+        burn_in=50,
+        num_metatrees=20,
+        seed=SEED,
+    )
+    x_continuous,x_categorical = _make_pred_test_data(model,rng,10)
+    assert x_continuous.shape[0] > 10, "no meta-tree splits a continuous feature"
+    y = y[rng.integers(n,size=x_continuous.shape[0])]
+
+    # the whole batch, and each sample alone (_p_n == 1)
+    for rows in [np.arange(x_continuous.shape[0])] + [[j] for j in range(x_continuous.shape[0])]:
+        desired = _brute_force_pred(model,x_continuous[rows],x_categorical[rows],y[rows])
+        model.calc_pred_dist(x_continuous[rows],x_categorical[rows])
+        if SubModel is categorical:
+            assert np.allclose(model.make_prediction(loss='KL'), desired['KL'])
+            assert np.all(model.make_prediction(loss='0-1') == np.argmax(desired['KL'],axis=1))
+        else:
+            assert np.allclose(model.make_prediction(loss='squared'), desired['squared'])
+            assert np.allclose(model.calc_pred_var(), desired['var'])
+        assert np.allclose(model.calc_pred_density(y[rows]), desired['density'])
+
+@pytest.mark.parametrize('alg_type,kwargs',[('MTMCMC',{}),('REMTMCMC',{'num_chains':2})])
+def test_metatree_mcmc_single_usable_feature(metatree_sample_data,alg_type,kwargs):
+    # the second feature is never assigned, so the feature of a node cannot be changed in the MH steps
+    model = metatree.LearnModel(
+        c_dim_continuous=3,
+        c_dim_categorical=0,
+        c_num_assignment_vec=np.array([-1,0,0]),
+        SubModel=normal,
+    )
+    model.update_posterior(
+        x_continuous=metatree_sample_data['x_continuous'],
+        y=metatree_sample_data['y_continuous'],
+        alg_type=alg_type,
+        burn_in=20,
+        num_metatrees=10,
+        seed=SEED,
+        **kwargs,
+    )
+    assert len(model.hn_metatree_list) == 1
+    assert np.all(model.hn_metatree_prob_vec == 1)
+    stack = [model.hn_metatree_list[0]]
+    while stack:
+        node = stack.pop()
+        if not node.leaf:
+            assert node.k == 0
+            stack.extend(node.children)
+
+def _assert_same_metatree(root1,root2):
+    snapshot1 = _metatree_snapshot(root1)
+    snapshot2 = _metatree_snapshot(root2)
+    assert len(snapshot1) == len(snapshot2)
+    for node1,node2 in zip(snapshot1,snapshot2):
+        assert node1[:3] == node2[:3]
+        assert np.array_equal(node1[3],node2[3])
+        assert node1[4] == node2[4]
+        for key in node1[5]:
+            assert np.array_equal(node1[5][key],node2[5][key])
+
+def _in_order_map_index(model):
+    # the meta-trees are scanned in order and the first one is taken in case of a tie
+    map_index = 0
+    map_prob = -1.0
+    for i,metatree_prob in enumerate(model.hn_metatree_prob_vec):
+        prob = metatree_prob * model._map_recursion(model.hn_metatree_list[i],{},False)
+        if prob > map_prob:
+            map_index = i
+            map_prob = prob
+    return map_index
+
+def _estimate_map_metatree(metatree_list,metatree_prob_vec):
+    model = metatree.LearnModel(
+        c_dim_continuous=3,
+        c_dim_categorical=2,
+        SubModel=normal,
+    )
+    model.set_hn_params(
+        hn_metatree_list=metatree_list,
+        hn_metatree_prob_vec=metatree_prob_vec,
+    )
+    return model, model.estimate_params(visualize=False)
+
+def test_metatree_estimate_params_scan(metatree_sample_data):
+    # initialise the model
+    model = metatree.LearnModel(
+        c_dim_continuous=3,
+        c_dim_categorical=2,
+        SubModel=normal,
+    )
+    # update the posterior distribution
+    model.update_posterior(
+        x_continuous=metatree_sample_data['x_continuous'],
+        x_categorical=metatree_sample_data['x_categorical'],
+        y=metatree_sample_data['y_continuous'],
+        n_estimators=10,
+        random_state=123,
+    )
+    metatree_list = model.hn_metatree_list
+    num_metatrees = len(metatree_list)
+    assert num_metatrees >= 3
+
+    # concentrated posteriors on each of the meta-trees, and a flat one
+    rng = np.random.default_rng(SEED)
+    for j in range(num_metatrees+1):
+        metatree_prob_vec = rng.dirichlet(np.ones(num_metatrees)*0.1)
+        if j < num_metatrees:
+            metatree_prob_vec *= 0.1
+            metatree_prob_vec[j] += 0.9
+        else:
+            metatree_prob_vec = np.ones(num_metatrees) / num_metatrees
+        tmp_model,map_root = _estimate_map_metatree(metatree_list,metatree_prob_vec)
+        map_index = _in_order_map_index(tmp_model)
+        _,desired_map_root = _estimate_map_metatree([metatree_list[map_index]],np.ones(1))
+        _assert_same_metatree(map_root,desired_map_root)
+
+    # two meta-trees with the same structure and h_g, but different sub model parameters, 
+    # have the same probability, and the first one is taken
+    metatree_list = [metatree_list[0],copy.deepcopy(metatree_list[0])]
+    stack = [metatree_list[1]]
+    while stack:
+        node = stack.pop()
+        node.sub_model.hn_m = node.sub_model.hn_m + 1.0
+        if not node.leaf:
+            stack.extend(node.children)
+    for order in [[0,1],[1,0]]:
+        _,map_root = _estimate_map_metatree([metatree_list[i] for i in order],np.ones(2)/2)
+        _,desired_map_root = _estimate_map_metatree([metatree_list[order[0]]],np.ones(1))
+        _assert_same_metatree(map_root,desired_map_root)
+    assert not np.isclose(map_root.sub_model.hn_m,_estimate_map_metatree(metatree_list[:1],np.ones(1))[1].sub_model.hn_m)
+
+def test_metatree_feature_importances():
+    _Node = metatree._metatree._Node
+    def leaf(depth,log_marginal_likelihood):
+        return _Node(depth,leaf=True,log_marginal_likelihood=log_marginal_likelihood)
+    # meta-tree 1: x_1 at the root (h_g=0.6), and x_0 at its second child (h_g=0.5)
+    metatree1 = _Node(0,h_g=0.6,k=1,log_marginal_likelihood=-10.0,children=[
+        leaf(1,-4.0),
+        _Node(1,h_g=0.5,k=0,log_marginal_likelihood=-5.0,children=[leaf(2,-2.0),leaf(2,-2.5)]),
+    ])
+    # meta-tree 2: x_0 at the root (h_g=0.2)
+    metatree2 = _Node(0,h_g=0.2,k=0,log_marginal_likelihood=-8.0,children=[leaf(1,-3.0),leaf(1,-4.0)])
+    # meta-tree 3: x_2 at the root, but its posterior probability is negligible
+    metatree3 = _Node(0,h_g=1.0,k=2,log_marginal_likelihood=0.0,children=[leaf(1,1000.0),leaf(1,1000.0)])
+
+    model = metatree.LearnModel(
+        c_dim_continuous=0,
+        c_dim_categorical=3,
+        c_max_depth=2,
+    )
+    model.hn_metatree_list = [metatree1,metatree2,metatree3]
+    model.hn_metatree_prob_vec = np.array([0.7,0.3-1.0e-13,1.0e-13])
+
+    # x_0: 0.7 * (0.6*0.5) * ((-2.0-2.5)-(-5.0)) + 0.3 * 0.2 * ((-3.0-4.0)-(-8.0))
+    # x_1: 0.7 * 0.6 * ((-4.0-5.0)-(-10.0))
+    desired_feature_importances = np.array([0.7*0.3*0.5 + 0.3*0.2*1.0, 0.7*0.6*1.0, 0.0])
+    feature_importances = model.calc_feature_importances()
+    assert np.allclose(feature_importances, desired_feature_importances)
+    assert feature_importances[2] == 0.0
+
 if __name__ == "__main__":
     pytest.main()
\ No newline at end of file